@@ -1,97 +1,442 @@
-from os import listdir
-from os.path import isfile, join
-from random import random
+import asyncio
+import time
+from functools import partial
+from os import makedirs, remove
+from os.path import isdir, isfile, join
+from multiprocessing import Pool, cpu_count
 
-import cv2
 import numpy as np
-from queue import Queue
+from threading import Event, Lock
 
-if __name__ != "__main__":
+# Relative imports only work when loaded as part of the package, the
+# other modules import each other the same way
+if __package__:
     from . import ObjClass2 as ObjClass
+    from . import cachemanifest
+    from . import filescan
+    from . import labelindex
     from . import userio
+    from .dynamicload import DynamicLoader
+    from .feederstats import FeederStats
+    from .framecache import FrameCache
+    from .reservoir import TileReservoir
+    from .sampler import EpochSampler
+    from .shardcache import ShardWindow, ShardWriter, save_array
+    from .shmpool import SharedBatchPool
+    from .tiling import (IMAGE_FOLDER, LABEL_FOLDER, breakdown_n_filter, load_file,
+                         load_tiles, tile_grid)
 else:
     import ObjClass2 as ObjClass
+    import cachemanifest
+    import filescan
+    import labelindex
     import userio
+    from dynamicload import DynamicLoader
+    from feederstats import FeederStats
+    from framecache import FrameCache
+    from reservoir import TileReservoir
+    from sampler import EpochSampler
+    from shardcache import ShardWindow, ShardWriter, save_array
+    from shmpool import SharedBatchPool
+    from tiling import (IMAGE_FOLDER, LABEL_FOLDER, breakdown_n_filter, load_file,
+                        load_tiles, tile_grid)
 
 CACHE_EXT = ".npz"
+MMAP_CACHE_EXT = ".npy"
 
-IMAGE_FOLDER = "raw_img/"
-LABEL_FOLDER = "label/"
+CACHE_FORMAT_NPZ = "npz"
+CACHE_FORMAT_MMAP = "mmap"
+CACHE_FORMAT_SHARDED = "sharded"
+CACHE_FORMATS = (CACHE_FORMAT_NPZ, CACHE_FORMAT_MMAP, CACHE_FORMAT_SHARDED)
 
-LOAD_N_IMAGES_AT_A_TIME = 10
+# What to do when the cache is missing or out of date
+MISSING_CACHE_ASK = "ask"
+MISSING_CACHE_BUILD = "build"
+MISSING_CACHE_FAIL = "fail"
+MISSING_CACHE_ACTIONS = (MISSING_CACHE_ASK, MISSING_CACHE_BUILD, MISSING_CACHE_FAIL)
+
+# Tiles per shard of a sharded cache, and shards kept in memory
+SHARD_SIZE = 4096
+RESIDENT_SHARDS = 4
+
+# Tiles the dynamic_load reservoir holds, batches are drawn out of them
+PREFETCH_DEPTH = 1024
+
+# Batches between two calls of the stats_callback
+STATS_INTERVAL = 100
+
+# Newly indexed files after which dynamic loading saves the label index
+LABEL_INDEX_SAVE_INTERVAL = 256
 
 def dummy(input):
     return input
 
-class DataFeeder(object):
+class DataFeeder(DynamicLoader):
     def __init__(self, data_path, cache_name="cache", dynamic_load=False,
                  raw_preprocess=dummy, label_preprocess=dummy,
-                 data_padding=0, label_width=64, label_height=None):
+                 data_padding=0, label_width=64, label_height=None,
+                 cache_format=CACHE_FORMAT_NPZ, workers=1,
+                 prefetch_workers=0, prefetch_depth=PREFETCH_DEPTH,
+                 label_codec=ObjClass, seed=None, rank=0, world_size=1,
+                 shard_size=SHARD_SIZE, resident_shards=RESIDENT_SHARDS,
+                 missing_cache=MISSING_CACHE_ASK, stats=False, stats_callback=None,
+                 stats_interval=STATS_INTERVAL, target_size=None,
+                 worker_processes=0, batch_views=False, min_label_pixels=1,
+                 io_block_size=1, read_ahead=False, frame_cache_bytes=0,
+                 frame_cache_tiles=False, discover_interval=None,
+                 raw_batch_preprocess=dummy, label_batch_preprocess=dummy,
+                 tile_batch_preprocess=dummy, batch_preprocess_on_workers=False):
         if label_height is None:
             label_height = label_width
+        assert cache_format in CACHE_FORMATS, "Unknown cache_format {}".format(cache_format)
+        assert missing_cache in MISSING_CACHE_ACTIONS, \
+            "Unknown missing_cache {}".format(missing_cache)
 
-        self._counter = 0
         self._data_path = data_path
         self._dynamic_load = dynamic_load
         self._cache_name = cache_name
+        self._cache_format = cache_format
+        # Build without asking in batch jobs, or fail instead of blocking on input
+        self._missing_cache = missing_cache
+        # Number of processes used to build the cache
+        self._workers = cpu_count() if workers is None else workers
         self._data_padding = data_padding
 
         self._raw_preprocess = raw_preprocess
         self._label_preprocess = label_preprocess
+        # Hooks taking the stacked (N, H, W, C) frames of dynamic_load, of
+        # one shape each call, before tiling, and the image tiles of every
+        # batch. With batch_preprocess_on_workers tiles of dynamic_load go
+        # through tile_batch_preprocess as they are loaded, on the prefetch
+        # threads or worker_processes, instead of in get_batch
+        self._raw_batch_preprocess = raw_batch_preprocess
+        self._label_batch_preprocess = label_batch_preprocess
+        self._tile_batch_preprocess = tile_batch_preprocess
+        self._batch_preprocess_on_workers = batch_preprocess_on_workers and dynamic_load
+        self._preprocess_batches = (tile_batch_preprocess is not dummy
+                                    and not self._batch_preprocess_on_workers)
+        self._labels_batched = label_batch_preprocess is not dummy
+        # (width, height) frames and labels are decoded at, None keeps their size
+        self._target_size = None if target_size is None else tuple(target_size)
+        # Labelled pixels a tile needs to be kept
+        self._min_label_pixels = min_label_pixels
 
         self._label_width = label_width
         self._label_height = label_height
 
+        # Tiles kept of every file, by file name, see labelindex. Only used
+        # when loading dynamically if the labels are not preprocessed
+        self._label_index = labelindex.LabelIndex(
+            join(data_path, labelindex.LABEL_INDEX_FILE), self._label_index_settings(),
+            LABEL_INDEX_SAVE_INTERVAL)
+        self._use_label_index = label_preprocess is dummy and label_batch_preprocess is dummy
+        # ObjClass (9 colors) or ObjClass2 (binary alpha), labels are stored
+        # in their compact_label form and expanded by get_batch
+        self._label_codec = label_codec
+
         self._img_data = None
         self._label_data = None
 
+        self._seed = seed
+        self._rank = rank
+        self._world_size = world_size
+
+        # Sharded caches are streamed through a ShardWindow instead of _img_data
+        self._shard_size = shard_size
+        self._resident_shards = resident_shards
+        self._shards = None
+
         self._file_list = None
-        self._dynamic_load_buffer = Queue()
+        # Loaded tiles of dynamic_load with the epoch of their file, up to
+        # prefetch_depth of them. Batches are drawn at random out of it
+        # when shuffling, which mixes tiles of different frames
+        self._reservoir = TileReservoir(prefetch_depth)
+
+        # Stage timings and counters, see stats(). stats_callback gets them
+        # every stats_interval batches
+        self._stats = FeederStats(stats or stats_callback is not None)
+        self._stats_callback = stats_callback
+        self._stats_interval = stats_interval
+        self._batches_since_stats = 0
+        self._index_lock = Lock()
+        # Epoch boundaries crossed since get_batch last printed them
+        self._epoch_ends = 0
+
+        # Background loading for dynamic_load, 0 workers loads inside get_batch
+        self._prefetch_workers = prefetch_workers
+        self._prefetch_depth = prefetch_depth
+        self._prefetch_shuffle = None
+        self._prefetch_threads = []
+        self._prefetch_stop = Event()
+        self._prefetch_error = None
+
+        # Processes loading whole batches into shared memory for
+        # dynamic_load, used instead of the prefetch threads when set.
+        # With batch_views get_batch returns views of the shared batch,
+        # valid until the next get_batch, instead of a copy
+        self._worker_processes = worker_processes
+        self._batch_views = batch_views
+        self._pool = None
+
+        # Shuffled dynamic loading reads runs of io_block_size consecutive
+        # files, in a shuffled run order, the reservoir mixes their tiles.
+        # With read_ahead the files of a refill are hinted to the OS first
+        self._io_block_size = io_block_size
+        self._read_ahead = read_ahead
+
+        # Decoded and preprocessed frames of dynamic_load kept in memory up
+        # to frame_cache_bytes, or with frame_cache_tiles their kept tiles
+        # and compact labels, which are smaller and skip tiling as well
+        self._frame_cache = None
+        if frame_cache_bytes > 0:
+            self._frame_cache = FrameCache(frame_cache_bytes)
+        self._frame_cache_tiles = frame_cache_tiles
+
+        # Listings of the image and label folders, see filescan. With a
+        # discover_interval dynamic_load looks for newly labelled files
+        # every discover_interval seconds, see refresh_files
+        self._listing = filescan.DataSetListing(data_path, (IMAGE_FOLDER, LABEL_FOLDER))
+        self._discover_interval = discover_interval
+        self._last_discovery = time.time()
 
         if not dynamic_load:
             self._load_cache()
             print("DataFeeder loaded the cache")
+            # Samples tiles in memory, shards of a sharded cache, files when
+            # loading dynamically
+            if self._shards is not None:
+                self._sampler = self._shards.sampler
+            else:
+                self._sampler = EpochSampler(len(self._img_data), seed, rank, world_size)
         else:
             self._file_list = self._check_data_dir()
-
+            self._sampler = EpochSampler(len(self._file_list), seed, rank, world_size,
+                                         io_block_size)
+            if self._use_label_index:
+                self._read_label_index(self._file_list)
+        self._tile_random_state = np.random.RandomState(self._sampler.seed)
+
+        # Epoch of the last tile handed out, and of the last file drawn by
+        # each producer (the refill inside get_batch is producer 0)
+        self._consumer_epoch = self._sampler.epoch
+        self._producer_epochs = [self._sampler.epoch]
+
+    def _cache_path(self, name=None):
+        "Path of the cache file, or of one array inside an mmap cache"
+        if self._cache_format in (CACHE_FORMAT_MMAP, CACHE_FORMAT_SHARDED):
+            # mmap caches are a directory holding one raw .npy per array,
+            # sharded ones hold one per array and shard
+            cache_dir = join(self._data_path, self._cache_name)
+            if name is None:
+                return cache_dir
+            return join(cache_dir, name+MMAP_CACHE_EXT)
+        return join(self._data_path, self._cache_name+CACHE_EXT)
+
+    def _manifest_path(self):
+        "Path of the cache manifest, mmap and sharded caches keep it in their directory"
+        if self._cache_format in (CACHE_FORMAT_MMAP, CACHE_FORMAT_SHARDED):
+            # Both formats may share the directory
+            return join(self._cache_path(), self._cache_format+cachemanifest.MANIFEST_EXT)
+        return join(self._data_path, self._cache_name+cachemanifest.MANIFEST_EXT)
+
+    def _cache_fingerprint(self):
+        "Settings that change the content of the cache"
+        fingerprint = {
+            "version": cachemanifest.CACHE_VERSION,
+            "data_padding": self._data_padding,
+            "label_height": self._label_height,
+            "label_width": self._label_width,
+            "label_codec": self._label_codec.__name__.split(".")[-1],
+        }
+        # Left out when unset so caches built before these settings stay valid
+        if self._target_size is not None:
+            fingerprint["target_size"] = list(self._target_size)
+        if self._min_label_pixels != 1:
+            fingerprint["min_label_pixels"] = self._min_label_pixels
+        return fingerprint
+
+    def _file_states(self):
+        """(sizes, mtimes) of every image, label pair by file name
+
+        Read from the files themselves, a file rewritten in place keeps its
+        listing but not its size and mtime"""
+        img_files = self._listing.file_states(IMAGE_FOLDER)
+        label_files = self._listing.file_states(LABEL_FOLDER)
+        return {file_name: ([img_state[0], label_files[file_name][0]],
+                            [img_state[1], label_files[file_name][1]])
+                for file_name, img_state in img_files.items() if file_name in label_files}
+
+    def _label_index_settings(self):
+        "Settings that change which tiles are kept"
+        return {
+            "data_padding": self._data_padding,
+            "label_height": self._label_height,
+            "label_width": self._label_width,
+            "target_size": None if self._target_size is None else list(self._target_size),
+            "min_label_pixels": self._min_label_pixels,
+        }
+
+    def _read_label_index(self, file_list):
+        "Loads the entries of the saved label index that are still valid for file_list"
+        label_files = self._listing.file_states(LABEL_FOLDER)
+        self._label_index.load({file_name: label_files[file_name]
+                                for file_name in file_list if file_name in label_files})
+
+    def _read_cache_arrays(self):
+        "Returns img_data, label_data of the cache file"
+        if self._cache_format == CACHE_FORMAT_MMAP:
+            # Pages are read on demand and shared between processes
+            return (np.load(self._cache_path("img_data"), mmap_mode='r'),
+                    np.load(self._cache_path("label_data"), mmap_mode='r'))
+        with open(self._cache_path(), "rb") as cache_file:
+            npz_file = np.load(cache_file)
+            return (npz_file['img_data'], npz_file['label_data'])
+
+    def _cache_is_stale(self):
+        "Whether the files or settings changed since the cache was built"
+        if not (isdir(join(self._data_path, IMAGE_FOLDER))
+                and isdir(join(self._data_path, LABEL_FOLDER))):
+            # A cache shipped without its data set can only be taken as is
+            print("Data folders not found in {}, the cache is not checked".format(
+                self._data_path))
+            return False
+        file_list = self._check_data_dir()
+        states = self._file_states()
+        file_states = [(file_name,) + states[file_name] for file_name in file_list]
+        return cachemanifest.is_stale(cachemanifest.read_manifest(self._manifest_path()),
+                                      self._cache_fingerprint(), file_states)
 
     def _load_cache(self):
         while True:
-            cache_file = None
             try:
-                cache_path = join(self._data_path, self._cache_name+CACHE_EXT)
-                cache_file = open(cache_path, "rb")
-                npz_file = np.load(cache_file)
-                self._img_data = npz_file['img_data']
-                self._label_data = npz_file['label_data']
-                return
+                if self._cache_format == CACHE_FORMAT_SHARDED:
+                    self._shards = ShardWindow(self._cache_path(), self._resident_shards,
+                                               self._seed, self._rank, self._world_size)
+                else:
+                    self._img_data, self._label_data = self._read_cache_arrays()
             except IOError as error:
                 if(error.errno == 2 # No such file or directory
-                   and userio.confirm("Cache not found, want to rebuild cache?")):
+                   and self._confirm_build("Cache not found, want to rebuild cache?")):
                     self._build_cache()
                     continue
                 else: raise error
-            finally:
-                if cache_file is not None:
-                    cache_file.close()
+            if self._label_data is not None and self._label_data.dtype != np.uint8:
+                # Built before labels were stored in their compact form, out of
+                # date whatever its manifest says
+                self._img_data = self._label_data = None
+                if (self._missing_cache != MISSING_CACHE_FAIL and self._confirm_build(
+                        "Cache is from an older version, want to rebuild cache?")):
+                    self._build_cache()
+                    continue
+                raise RuntimeError("Cache {} holds one-hot labels of an older version".format(
+                    self._cache_path()))
+            if self._cache_is_stale():
+                if self._missing_cache == MISSING_CACHE_FAIL:
+                    raise RuntimeError("Cache {} is out of date".format(self._cache_path()))
+                if self._confirm_build("Cache is out of date, want to update cache?"):
+                    self._build_cache()
+                    continue
+            return
+
+    def _confirm_build(self, message_str):
+        "Whether to build the cache, asks only in MISSING_CACHE_ASK mode"
+        if self._missing_cache == MISSING_CACHE_ASK:
+            return userio.confirm(message_str)
+        return self._missing_cache == MISSING_CACHE_BUILD
+
+    def _cached_tiles(self):
+        """Tiles of the current cache that are still valid
+
+        Maps file name to (manifest entry, img_data, label_data). A file is
+        reused when its size and mtime are unchanged, or its content hash is.
+        Sharded caches are always rebuilt in full"""
+        if self._cache_format == CACHE_FORMAT_SHARDED:
+            return {}
+        manifest = cachemanifest.read_manifest(self._manifest_path())
+        if manifest is None or manifest["fingerprint"] != self._cache_fingerprint():
+            return {}
+        try:
+            img_data, label_data = self._read_cache_arrays()
+        except IOError:
+            return {}
+
+        states = self._file_states()
+        cached = {}
+        for file_name, (entry, start, count) in cachemanifest.manifest_offsets(manifest).items():
+            if entry["hash"] is None or file_name not in states:
+                continue
+            sizes, mtimes = states[file_name]
+            if sizes != entry["size"] or mtimes != entry["mtime"]:
+                img_file_path = join(self._data_path, IMAGE_FOLDER, file_name)
+                label_file_path = join(self._data_path, LABEL_FOLDER, file_name)
+                if cachemanifest.file_digest(img_file_path, label_file_path) != entry["hash"]:
+                    continue
+                entry = dict(entry, size=sizes, mtime=mtimes)
+            cached[file_name] = (entry, img_data[start:start+count], label_data[start:start+count])
+        return cached
 
-    def _build_cache(self):
-        "Creates cache file"
+    def build_cache(self, slient=True, progress=None):
+        """Creates or updates the cache file without loading it
+
+        progress is called with the manifest entry of every file and whether
+        it was decoded, rather than reused from the previous cache"""
+        self._build_cache(slient, progress)
+
+    def _build_cache(self, slient=False, progress=None):
+        "Creates cache file, only files changed since the last build are decoded"
         print("Building Cache")
+
+        # The manifest goes last, offsets in an old one do not match the new arrays
+        manifest_path = self._manifest_path()
+        cached = self._cached_tiles()
+        if cached:
+            print("Reusing {} cached files".format(len(cached)))
+
         # Cache files
-        cache_path = join(self._data_path, self._cache_name+CACHE_EXT)
-        img_data, label_data = self._load_data(slient=False)
-        cache_file = open(cache_path, "wb")
-        np.savez_compressed(cache_file, img_data=img_data, label_data=label_data)
-        cache_file.close()
+        cache_path = self._cache_path()
+        if self._cache_format == CACHE_FORMAT_SHARDED:
+            if isfile(manifest_path):
+                remove(manifest_path)
+            # Tiles go straight to disk, the data set never has to fit in memory
+            writer = ShardWriter(cache_path, self._shard_size)
+            entries = []
+            for t_img_data, t_label_data, entry in self._iter_data(slient, cached, progress):
+                entries.append(entry)
+                if t_img_data is not None:
+                    writer.add(t_img_data, t_label_data)
+            writer.close()
+        else:
+            img_data, label_data, entries = self._load_data(slient, cached, progress)
+            if isfile(manifest_path):
+                remove(manifest_path)
+
+            if self._cache_format == CACHE_FORMAT_MMAP:
+                if not isdir(cache_path):
+                    makedirs(cache_path)
+                save_array(self._cache_path("img_data"), img_data)
+                save_array(self._cache_path("label_data"), label_data)
+            else:
+                cache_file = open(cache_path, "wb")
+                np.savez_compressed(cache_file, img_data=img_data, label_data=label_data)
+                cache_file.close()
+
+        cachemanifest.write_manifest(manifest_path, self._cache_fingerprint(), entries)
         print("Cache file created at {}".format(cache_path))
 
     def _check_data_dir(self):
         # Load data
         raw_img_folder_path = join(self._data_path, IMAGE_FOLDER)
         label_folder_path = join(self._data_path, LABEL_FOLDER)
-        img_list = DataFeeder.get_file_list(raw_img_folder_path)
-        label_list = DataFeeder.get_file_list(label_folder_path)
+        img_list, label_list = self._listing.scan()
+
+        if self._dynamic_load:
+            # Images may still wait for their label, see refresh_files
+            labelled = set(label_list)
+            file_list = [file_name for file_name in img_list if file_name in labelled]
+            if len(file_list) < len(img_list):
+                print("{} images in {} have no label in {} yet, they are left out".format(
+                    len(img_list) - len(file_list), raw_img_folder_path, label_folder_path))
+            return file_list
 
         # Check Files in Image and Label folder matches
         assert img_list == label_list, "Files in {} and {} do not match".format(
@@ -99,192 +444,413 @@ class DataFeeder(object):
 
         return (img_list)
 
-    def _load_data(self, slient=True):
-        "Loads data from the provided data_path"
+    def _iter_data(self, slient=True, cached=None, progress=None):
+        """Loads data from the provided data_path, one file at a time
 
-        raw_img_folder_path = join(self._data_path, IMAGE_FOLDER)
-        label_folder_path = join(self._data_path, LABEL_FOLDER)
+        Files in cached, see _cached_tiles, are taken from there instead of
+        being decoded. Files the label index knows to have no kept tile are
+        not read at all. Yields the tiles of each file with its cache
+        manifest entry, tiles are None for files without any"""
+        if cached is None:
+            cached = {}
 
         file_list = self._check_data_dir()
-
+        states = self._file_states()
+        file_states = [states[file_name] for file_name in file_list]
+        # The cache is built from labels as they are, the index always applies
+        self._read_label_index(file_list)
+        empty = self._label_index.empty_files()
+
+        tasks = [(self._data_path, file_name, self._data_padding,
+                  self._label_height, self._label_width, self._label_codec.__name__,
+                  self._target_size, self._min_label_pixels)
+                 for file_name in file_list if file_name not in cached and file_name not in empty]
+
+        pool = None
+        if self._workers > 1:
+            pool = Pool(self._workers)
+            # imap keeps file_list order, so the cache matches a serial build
+            results = pool.imap(load_file, tasks)
+        else:
+            results = map(load_file, tasks)
+
+        try:
+            for file_name, (sizes, mtimes) in zip(file_list, file_states):
+                # Tiles have the same shape whatever the frame size, so frames
+                # of every resolution go into the one cache
+                decoded = False
+                if file_name in cached:
+                    entry, t_img_data, t_label_data = cached[file_name]
+                    t_img_shape = tuple(entry["shape"])
+                    digest = entry["hash"]
+                elif file_name in empty:
+                    t_img_shape = tuple(self._label_index.get(file_name)["shape"]) + (3,)
+                    t_img_data = t_label_data = digest = None
+                else:
+                    t_img_shape, t_img_data, t_label_data, digest, tiles = next(results)
+                    self._label_index.record(file_name, labelindex.make_entry(
+                        join(self._data_path, LABEL_FOLDER, file_name), t_img_shape, tiles))
+                    decoded = True
+
+                if not slient and decoded:
+                    print("Reading", file_name)
+
+                entry = {"name": file_name, "size": sizes, "mtime": mtimes,
+                         "hash": digest, "shape": list(t_img_shape),
+                         "tiles": 0 if t_img_data is None else len(t_img_data)}
+                if progress is not None:
+                    progress(entry, decoded)
+
+                yield (t_img_data, t_label_data, entry)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        self._label_index.save()
+
+    def _load_data(self, slient=True, cached=None, progress=None):
+        """Loads data from the provided data_path
+
+        Returns the tiles of every file and their cache manifest entries"""
         img_data = []
         label_data = []
+        entries = []
 
-        for file_enum in enumerate(file_list):
-            counter = file_enum[0]
-            file_name = file_enum[1]
-
-            img_file_path = join(raw_img_folder_path, file_name)
-            t_img_data = cv2.imread(img_file_path)
-
-            label_file_path = join(label_folder_path, file_name)
-            t_label_data = cv2.imread(label_file_path, cv2.IMREAD_UNCHANGED)
-
-            if len(img_data) == 0 or img_data[-1].shape == t_img_data.shape:
+        for t_img_data, t_label_data, entry in self._iter_data(slient, cached, progress):
+            entries.append(entry)
+            if t_img_data is not None:
                 img_data.append(t_img_data)
                 label_data.append(t_label_data)
-            else: break
-
-            if not slient:
-                print("Reading", file_name)
-
-        img_data = np.array(img_data)
-        label_data = np.array(label_data)
-        img_data, label_data = self._breakdown_n_filter(img_data, label_data)
-
-        p_label_data = [None]*len(label_data)
-        for file_enum in enumerate(label_data):
-            index = file_enum[0]
-            p_label_data[index] = ObjClass.process_label(label_data[index])
-
-        return (img_data, p_label_data)
-
-    def _breakdown_n_filter(self, img_data, label_data):
-        # print(img_data.shape, label_data.shape)
-        assert img_data.shape[0] == label_data.shape[0], "img_data, label_data count do not match"
-        assert img_data.shape[1] == label_data.shape[1], "img_data, label_data height do not match"
-        assert img_data.shape[2] == label_data.shape[2], "img_data, label_data width do not match"
-        height = img_data.shape[1]
-        width = img_data.shape[2]
-        padding_y = self._data_padding
-        padding_x = self._data_padding
-        # print("self._data_padding", self._data_padding)
-
-        split_label_height = self._label_height
-        split_label_width = self._label_width
-        # print("split_label_height", split_label_height)
-        # print("split_label_width", split_label_width)
-
-        bimg_data = [None] * img_data.shape[0]
-        blabel_data = [None] * label_data.shape[0]
-
-        start_y_indexes = range(padding_y, height-split_label_height-padding_y+1, split_label_height)
-        start_x_indexes = range(padding_x, width-split_label_width-padding_x+1, split_label_width)
-
-        total_sub_img = len(start_y_indexes) * len(start_x_indexes)
-
-        for index, (image, label) in enumerate(zip(img_data, label_data)):
-            sub_image = [None] * total_sub_img
-            sub_label = [None] * total_sub_img
-            counter = 0
-            for start_y in start_y_indexes:
-                for start_x in start_x_indexes:
-                    sub_image[counter] = image[start_y-padding_y:
-                                               start_y+split_label_height+padding_y,
-                                               start_x-padding_x:
-                                               start_x+split_label_width +padding_x]
-                    sub_label[counter] = label[start_y:
-                                               start_y+split_label_height,
-                                               start_x:
-                                               start_x+split_label_width]
-                    counter += 1
-
-            bimg_data[index] = sub_image
-            blabel_data[index] = sub_label
-
-        bimg_data = np.concatenate(bimg_data)
-        blabel_data = np.concatenate(blabel_data)
-
-        # print(bimg_data.shape)
-        # print(blabel_data.shape)
-        keep = np.sum(blabel_data, axis=(1, 2, 3)) > 0
-        ## print(keep.shape)
-        bimg_data = bimg_data[keep]
-        blabel_data = blabel_data[keep]
-
-        # bimg_data = bimg_data
-        # blabel_data = blabel_data
-
-        return (bimg_data, blabel_data)
-
-    def _get_file_index(self, shuffle, bound):
-        if shuffle:
-            index = int(random()*bound)
+
+        img_data = np.concatenate(img_data)
+        label_data = np.concatenate(label_data)
+
+        return (img_data, label_data, entries)
+
+    def _breakdown_n_filter(self, img_data, label_data, return_frames=False):
+        frame_count, height, width = img_data.shape[:3]
+        with self._stats.timed("tiling"):
+            result = breakdown_n_filter(img_data, label_data, self._data_padding,
+                                        self._label_height, self._label_width, return_frames,
+                                        self._min_label_pixels)
+        if self._stats.enabled:
+            count_y, count_x = tile_grid(height, width, self._data_padding,
+                                         self._label_height, self._label_width)
+            self._stats.count("tiles_kept", len(result[0]))
+            self._stats.count("tiles_discarded", frame_count*count_y*count_x - len(result[0]))
+        return result
+
+    def _get_file_indexes(self, shuffle, size):
+        """Next size tile (file when loading dynamically) indexes of this rank
+
+        Also returns the epoch each index belongs to"""
+        with self._index_lock:
+            epochs = self._sampler.index_epochs(size)
+            indexes, epoch_ends = self._sampler.next_indexes(size, shuffle)
+            self._epoch_ends += epoch_ends
+        return (indexes, epochs)
+
+    def _print_epoch_ends(self):
+        "Prints the epoch boundaries crossed since the last call, as get_batch always did"
+        with self._index_lock:
+            epoch_ends, self._epoch_ends = self._epoch_ends, 0
+        if epoch_ends:
+            print("data counter reset")
+
+    @property
+    def epoch(self):
+        "Current epoch of the sampler"
+        return self._sampler.epoch
+
+    def set_epoch(self, epoch):
+        "Restarts sampling at the beginning of the given epoch"
+        with self._index_lock:
+            self._sampler.set_epoch(epoch)
+            self._consumer_epoch = epoch
+            self._producer_epochs = [epoch] * len(self._producer_epochs)
+
+    def refresh_files(self):
+        """Adds files labelled since the file list was made, for dynamic_load
+
+        Files having both an image and a label that are not sampled yet are
+        appended to the file list. They are sampled from the next epoch the
+        sampler starts on, which may already be loading ahead of the
+        batches handed out. Removed files stay in the list. Running
+        worker_processes keep their file list until close(). Returns the
+        names of the added files"""
+        assert self._dynamic_load, "Only dynamic_load can take on new files"
+        img_list, label_list = self._listing.scan()
+        with self._index_lock:
+            known = set(self._file_list)
+            labelled = set(label_list)
+            added = [file_name for file_name in img_list
+                     if file_name in labelled and file_name not in known]
+            if added:
+                self._file_list.extend(added)
+                self._sampler.resize(len(self._file_list))
+        if added:
+            self._stats.count("files_discovered", len(added))
+        return added
+
+    def _discover_files(self):
+        "Calls refresh_files once discover_interval seconds passed since the last time"
+        if self._discover_interval is None:
+            return
+        with self._index_lock:
+            now = time.time()
+            if now - self._last_discovery < self._discover_interval:
+                return
+            self._last_discovery = now
+        self.refresh_files()
+
+    def _start_pool(self, size, shuffle):
+        "Starts the worker_processes on the first dynamic get_batch"
+        if self._pool is not None:
+            assert (self._pool.batch_size, self._pool.shuffle) == (size, shuffle), \
+                ("size and shuffle can not change with worker_processes, "
+                 "close() the DataFeeder first")
+            return
+
+        settings = (self._data_path, self._data_padding, self._label_height, self._label_width,
+                    self._label_codec.__name__, self._target_size, self._min_label_pixels,
+                    self._raw_preprocess, self._label_preprocess,
+                    self._raw_batch_preprocess, self._label_batch_preprocess,
+                    self._tile_batch_preprocess if self._batch_preprocess_on_workers else dummy,
+                    self._label_index.empty_files())
+        # prefetch_depth tiles ready, and a slot being filled by every worker
+        slots = -(-self._prefetch_depth // size) + self._worker_processes
+        self._pool = SharedBatchPool(load_tiles, settings, self._file_list, size, slots,
+                                     self._worker_processes, shuffle, self._sampler.seed,
+                                     self._rank, self._world_size, self._sampler.epoch,
+                                     self._io_block_size)
+
+    def _get_pool_batch(self, size, shuffle, sparse, out):
+        "Next batch of the worker_processes, a view or a single copy of shared memory"
+        img_out, label_out = (None, None) if out is None else out
+        self._start_pool(size, shuffle)
+
+        with self._stats.timed("consumer_wait"):
+            img_slot, label_slot = self._pool.get()
+
+        if self._batch_views and out is None:
+            return [img_slot, self._expand_label_batch(label_slot, sparse)]
+
+        if img_out is None:
+            img_batch = img_slot.copy()
         else:
-            index = self._counter
-            self._counter = (self._counter + 1) % bound
-            if self._counter == 0:
-                print("data counter reset")
-        return index
+            np.copyto(img_out, img_slot)
+            img_batch = img_out
+        label_batch = self._expand_label_batch(np.array(label_slot), sparse, out=label_out)
+        self._pool.release()
+        return [img_batch, label_batch]
+
+    def close(self):
+        "Stops the prefetch threads and worker processes, saves the label index"
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        self._prefetch_stop.set()
+        for thread in self._prefetch_threads:
+            thread.join()
+        self._prefetch_threads = []
+        self._label_index.save()
+        self._reservoir = TileReservoir(self._prefetch_depth)
+        self._producer_epochs = [self._sampler.epoch]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def stats(self):
+        """Returns the time per stage and the counters since construction
+
+        Only collected when the DataFeeder was made with stats=True or a
+        stats_callback. buffer_occupancy is the number of tiles ready in the
+        dynamic_load reservoir right now, frame_cache the hits and misses of
+        the frame cache, which are counted even without stats"""
+        snapshot = self._stats.snapshot()
+        snapshot["buffer_occupancy"] = len(self._reservoir)
+        snapshot["buffer_capacity"] = self._reservoir.capacity
+        if self._frame_cache is not None:
+            snapshot["frame_cache"] = self._frame_cache.stats()
+        return snapshot
+
+    def reset_stats(self):
+        "Clears the timings and counters"
+        self._stats.reset()
+
+    def _expand_label_batch(self, label_batch, sparse, out=None):
+        "Turns compact labels into class indexes or one-hot float labels"
+        with self._stats.timed("label_expand"):
+            label_batch = self._label_codec.sparse_label(label_batch, self._label_width)
+            if sparse:
+                if out is None:
+                    return label_batch
+                np.copyto(out, label_batch)
+                return out
+            return self._label_codec.expand_label(label_batch, out=out)
+
+    def _preprocess_batch(self, batch, out=None):
+        "Runs tile_batch_preprocess on the image tiles of a batch handed out"
+        if not self._preprocess_batches:
+            return batch
+        with self._stats.timed("tile_batch_preprocess"):
+            img_batch = self._tile_batch_preprocess(batch[0])
+        if out is not None and img_batch is not out[0]:
+            np.copyto(out[0], img_batch)
+            img_batch = out[0]
+        return [img_batch, batch[1]]
+
+    def get_batch(self, size, shuffle=False, slient=True, sparse=False, out=None):
+        """Returns a batch of data
+
+        Labels are one-hot float32, or uint8 class indexes when sparse is set.
+        out can be a pair of (image, label) arrays to write the batch into,
+        its image array takes the tiles as tile_batch_preprocess returns them"""
+
+        with self._stats.timed("get_batch"):
+            if out is not None and self._preprocess_batches:
+                # The hook may change the dtype, only its result goes to out
+                batch = self._preprocess_batch(
+                    self._get_batch(size, shuffle, slient, sparse, (None, out[1])), out)
+            else:
+                batch = self._preprocess_batch(
+                    self._get_batch(size, shuffle, slient, sparse, out))
+        self._count_batch(size)
+        self._print_epoch_ends()
+
+        return batch
+
+    def _count_batch(self, size):
+        "Updates the batch counters and calls the stats_callback when due"
+        self._stats.count("batches")
+        self._stats.count("samples", size)
+
+        if self._stats_callback is not None:
+            self._batches_since_stats += 1
+            if self._batches_since_stats >= self._stats_interval:
+                self._batches_since_stats = 0
+                self._stats_callback(self.stats())
+
+    def iter_batches(self, size, epochs=1, shuffle=False, slient=True, sparse=False):
+        """Yields batches until the end of epochs epochs, forever if None
+
+        The first epoch is whatever is left of the current one. Every tile of
+        an epoch is yielded once, so its last batch can hold less than size
+        tiles, and no batch mixes two epochs. A sharded cache has no tile
+        order to follow, its epochs are counted as len(cache)//world_size
+        tiles instead."""
+        done = 0
+        while epochs is None or done < epochs:
+            for batch in self._iter_epoch(size, shuffle, slient, sparse):
+                yield batch
+            done += 1
+
+    def _iter_epoch(self, size, shuffle, slient, sparse):
+        "Batches of the rest of the current epoch"
+        if self._dynamic_load:
+            for batch in self._iter_dynamic_epoch(size, shuffle, slient, sparse):
+                yield batch
+            return
+
+        if self._shards is not None:
+            left = len(self._shards) // self._world_size
+        else:
+            with self._index_lock:
+                left = self._sampler.remaining()
+        while left > 0:
+            count = min(size, left)
+            with self._stats.timed("get_batch"):
+                batch = self._preprocess_batch(
+                    self._get_batch(count, shuffle, slient, sparse, None))
+            self._count_batch(count)
+            left -= count
+            yield batch
+        # The epoch end is not news to the caller of iter_batches
+        with self._index_lock:
+            self._epoch_ends = 0
+
+    def _iter_dynamic_epoch(self, size, shuffle, slient, sparse):
+        "Batches of the buffered and still to load tiles of the current epoch"
+        assert self._worker_processes == 0, \
+            "worker_processes fill whole batches without epoch boundaries, use get_batch"
+        if self._prefetch_workers > 0:
+            self._start_prefetch(shuffle, slient)
+        epoch = self._consumer_epoch
+
+        while True:
+            with self._stats.timed("consumer_wait"):
+                img_batch, label_batch = self._take_tiles(size, shuffle, slient, epoch)
+            if len(img_batch) > 0:
+                self._count_batch(len(img_batch))
+                yield self._preprocess_batch(
+                    [img_batch, self._expand_label_batch(label_batch, sparse)])
+            if len(img_batch) < size:
+                break
+
+        with self._index_lock:
+            self._consumer_epoch = max(self._consumer_epoch, epoch + 1)
+            self._epoch_ends = 0
+
+    async def aget_batch(self, size, shuffle=False, slient=True, sparse=False, out=None):
+        """get_batch for asyncio, the event loop keeps running while the batch is made
+
+        The batch is made on the default executor, await one at a time"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, partial(self.get_batch, size, shuffle, slient, sparse, out))
+
+    async def aiter_batches(self, size, epochs=1, shuffle=False, slient=True, sparse=False):
+        "iter_batches for asyncio, each batch is made on the default executor"
+        loop = asyncio.get_running_loop()
+        batches = self.iter_batches(size, epochs, shuffle, slient, sparse)
+        while True:
+            batch = await loop.run_in_executor(None, next, batches, None)
+            if batch is None:
+                return
+            yield batch
 
-    def get_batch(self, size, shuffle=False, slient=True):
-        "Returns a batch of data"
+    def _get_batch(self, size, shuffle, slient, sparse, out):
+        img_out, label_out = (None, None) if out is None else out
 
-        img_batch = [None]*size
-        label_batch = [None]*size
+        if self._shards is not None:
+            with self._index_lock:
+                img_batch, label_batch, epoch_ends = self._shards.get_batch(size, shuffle, img_out)
+                self._epoch_ends += epoch_ends
+            return [img_batch, self._expand_label_batch(label_batch, sparse, out=label_out)]
 
         if not self._dynamic_load:
             # assert size <= len(self._img_data), "Batch bigger than Data Set"
 
-            for counter in range(size):
-                index = self._get_file_index(shuffle, len(self._img_data))
-
-                img_batch[counter] = self._img_data[index]
-                label_batch[counter] = self._label_data[index]
+            indexes, _ = self._get_file_indexes(shuffle, size)
 
-            img_batch = np.array(img_batch)
-            label_batch = np.array(label_batch)
+            with self._stats.timed("gather"):
+                img_batch = np.take(self._img_data, indexes, axis=0, out=img_out, mode='clip')
+                label_batch = np.take(self._label_data, indexes, axis=0)
+            label_batch = self._expand_label_batch(label_batch, sparse, out=label_out)
 
             return [img_batch, label_batch]
-        else:
-            raw_img_folder_path = join(self._data_path, IMAGE_FOLDER)
-            label_folder_path = join(self._data_path, LABEL_FOLDER)
-
-            while self._dynamic_load_buffer.qsize() < size:
-
-                img_data = []
-                label_data = []
-
-                for counter in range(LOAD_N_IMAGES_AT_A_TIME):
-                    index = self._get_file_index(shuffle, len(self._file_list))
-                    file_name = self._file_list[index]
-
-                    img_file_path = join(raw_img_folder_path, file_name)
-                    t_img_data = cv2.imread(img_file_path)
-                    t_img_data = self._raw_preprocess(t_img_data)
-
-                    label_file_path = join(label_folder_path, file_name)
-                    t_label_data = cv2.imread(label_file_path, cv2.IMREAD_UNCHANGED)
-                    t_label_data = self._label_preprocess(t_label_data)
 
-                    if len(img_data) == 0 or t_img_data.shape == img_data[-1].shape:
-                        img_data.append(t_img_data)
-                        label_data.append(t_label_data)
-                    else: break
-                    if not slient:
-                        print("Loading", file_name)
+        if self._worker_processes > 0:
+            return self._get_pool_batch(size, shuffle, sparse, out)
 
-                    # print(self._counter, counter, np.array(img_data[counter]).shape, np.array(label_data[counter]).shape)
+        if self._prefetch_workers > 0:
+            self._start_prefetch(shuffle, slient)
 
-                img_data = np.array(img_data)
-                label_data = np.array(label_data)
-                # print("FINAL SHAPE", img_data.shape, label_data.shape)
-                img_data, label_data = self._breakdown_n_filter(img_data, label_data)
+        # Time blocked on the producers or the refill, waiting for tiles
+        with self._stats.timed("consumer_wait"):
+            img_batch, label_batch = self._take_tiles(size, shuffle, slient, img_out=img_out)
+        label_batch = self._expand_label_batch(label_batch, sparse, out=label_out)
 
-                p_label_data = [None]*len(label_data)
-                for file_enum in enumerate(label_data):
-                    index = file_enum[0]
-                    p_label_data[index] = ObjClass.process_label(label_data[index])
-
-                for data in zip(img_data, p_label_data):
-                    self._dynamic_load_buffer.put(data)
-
-            for counter in range(size):
-                img_batch[counter], label_batch[counter] = self._dynamic_load_buffer.get()
-
-            img_batch = np.array(img_batch)
-            label_batch = np.array(label_batch)
-
-            return [img_batch, label_batch]
+        return [img_batch, label_batch]
 
     @staticmethod
     def get_file_list(path):
         "Return List of file in the provided path"
-        file_list = [file_name
-                     for file_name in listdir(path)
-                     if isfile(join(path, file_name))]
-        file_list.sort()
-        return file_list
+        return sorted(filescan.file_names(path))
 
 def main():
     "Example Usage"
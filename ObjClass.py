@@ -54,52 +54,71 @@ CLASS = [
     COIN,
 ]
 
-def process_label(cv_mat_raw_label):
-    "Take in a raw label and return a processed label"
-    range_imgs = [None]*len(CLASS)
-
-    for cl_enum in enumerate(CLASS):
-        index = cl_enum[0]
-        range_img = cv2.inRange(cv_mat_raw_label,
-                                CLASS[index].get_bgra(0),
-                                CLASS[index].get_bgra(255))
-
-        range_img = range_img.astype(np.float32)/255.
+NUM_CLASSES = len(CLASS)
+# Class index of pixels that match none of the CLASS colors
+NO_CLASS = NUM_CLASSES
 
-        range_imgs[index] = np.reshape(range_img, range_img.shape+(1,))
+def _bgr_key(bgr):
+    "Pack a bgr color into the integer key used by encode_label"
+    return int(bgr[0]) | int(bgr[1]) << 8 | int(bgr[2]) << 16
 
-    return np.concatenate(range_imgs, axis=2)
+# Palette table, sorted by key so lookups can use searchsorted
+_PALETTE_KEYS = np.array([_bgr_key(obj_class.get_bgr()) for obj_class in CLASS], dtype=np.uint32)
+_PALETTE_ORDER = np.argsort(_PALETTE_KEYS)
+_PALETTE_KEYS = _PALETTE_KEYS[_PALETTE_ORDER]
+_PALETTE_INDEX = _PALETTE_ORDER.astype(np.uint8)
 
-def combine_label(cv_mat_pro_label):
-    "Take in a raw label and return a processed label"
-    # get image shape without the class count
-    img_dimesion = cv_mat_pro_label.shape[:-1]
-
-    range_imgs = np.rollaxis(cv_mat_pro_label, axis=2)
+# Row NO_CLASS is all zeros
+_ONE_HOT = np.eye(NUM_CLASSES+1, NUM_CLASSES, dtype=np.float32)
 
-    lower_bound = np.array([0.5])
-    upper_bound = np.array([1.0])
+def encode_label(cv_mat_raw_label):
+    "Take in raw BGRA labels of any leading shape and return uint8 class indexes"
+    raw_label = np.ascontiguousarray(cv_mat_raw_label, dtype=np.uint8)
+    # Each BGRA pixel read as one little endian integer, alpha masked out
+    keys = raw_label.view("<u4")[..., 0] & 0xFFFFFF
 
-    result_img = np.zeros(shape=img_dimesion + (3,)).astype(np.uint8)
+    position = np.searchsorted(_PALETTE_KEYS, keys)
+    np.minimum(position, NUM_CLASSES-1, out=position)
 
-    for cl_enum in enumerate(CLASS):
-        index = cl_enum[0]
-        obj_class = cl_enum[1]
-        range_img = cv2.inRange(range_imgs[index], lower_bound, upper_bound)
-        # print(range_img.shape, img_dimesion + (1,))
-        range_img = np.reshape(range_img, img_dimesion + (1,)) / 255
-        b_color, g_color, r_color = obj_class.get_bgr()
-        b_sub_img = range_img * b_color
-        g_sub_img = range_img * g_color
-        r_sub_img = range_img * r_color
+    return np.where(_PALETTE_KEYS[position] == keys,
+                    _PALETTE_INDEX[position], NO_CLASS).astype(np.uint8)
 
-        bgr_img = np.concatenate([b_sub_img, g_sub_img, r_sub_img], axis=2).astype(np.uint8)
+def expand_label(label_index, out=None):
+    "Take in class indexes and return the one-hot processed label"
+    return np.take(_ONE_HOT, label_index, axis=0, out=out, mode='clip')
 
-        # print(result_img.dtype, bgr_img.dtype)
+def compact_label(cv_mat_raw_label):
+    "Take in raw labels and return the form stored in caches, class indexes"
+    return encode_label(cv_mat_raw_label)
 
-        result_img = cv2.add(result_img, bgr_img)
+def sparse_label(compact, width):
+    "Take in labels from compact_label and return uint8 class indexes"
+    # pylint: disable=W0613
+    return compact
 
-    return result_img
+def process_label(cv_mat_raw_label):
+    "Take in a raw label and return a processed label"
+    return expand_label(encode_label(cv_mat_raw_label))
+
+# Row NO_CLASS is black
+_BGR_PALETTE = np.array([obj_class.get_bgr() for obj_class in CLASS] + [[0, 0, 0]],
+                        dtype=np.uint8)
+
+def decode_label(cv_mat_pro_label):
+    "Take in processed labels or predictions and return uint8 class indexes"
+    label_index = np.argmax(cv_mat_pro_label, axis=-1).astype(np.uint8)
+    best = np.max(cv_mat_pro_label, axis=-1)
+    # Pixels whose best class is outside [0.5, 1.0] are left uncolored
+    label_index[(best < 0.5) | (best > 1.0)] = NO_CLASS
+    return label_index
+
+def color_label(label_index, out=None):
+    "Take in class indexes and return a bgr image, written into out if given"
+    return np.take(_BGR_PALETTE, label_index, axis=0, out=out, mode='clip')
+
+def combine_label(cv_mat_pro_label, out=None):
+    "Take in processed labels of any leading shape and return bgr images"
+    return color_label(decode_label(cv_mat_pro_label), out=out)
 
 def main():
     "Testing"
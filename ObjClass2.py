@@ -54,30 +54,46 @@ CLASS = [
     COIN,
 ]
 
-def process_label(cv_mat_raw_label):
-    "Take in a raw label and return a processed label"
-    range_img = [None, None]
+NUM_CLASSES = 2
+# Class 0 is labelled (alpha of at least 128), class 1 is background
+_ALPHA_TABLE = np.where(np.arange(256) >= 128, 0, 1).astype(np.uint8)
 
-    range_img[0] = cv2.inRange(cv_mat_raw_label,
-                               np.array([0, 0, 0, 128]),
-                               np.array([255, 255, 255, 255]))
+_ONE_HOT = np.eye(NUM_CLASSES, dtype=np.float32)
 
-    range_img[1] = 255 - range_img[0]
+def encode_label(cv_mat_raw_label):
+    "Take in raw BGRA labels of any leading shape and return uint8 class indexes"
+    return _ALPHA_TABLE[cv_mat_raw_label[..., 3]]
 
-    for index in range(2):
-        range_img[index] = range_img[index].astype(np.float32)/255.
+def expand_label(label_index, out=None):
+    "Take in class indexes and return the one-hot processed label"
+    return np.take(_ONE_HOT, label_index, axis=0, out=out, mode='clip')
 
-        range_img[index] = np.reshape(range_img[index], range_img[index].shape+(1,))
+def compact_label(cv_mat_raw_label):
+    "Take in raw labels and return the form stored in caches, 1 bit per pixel"
+    return np.packbits(encode_label(cv_mat_raw_label), axis=-1)
 
-        # print(range_img[index].shape)
+def sparse_label(compact, width):
+    "Take in labels from compact_label and return uint8 class indexes"
+    return np.unpackbits(compact, axis=-1, count=width)
 
-    return np.concatenate(range_img, axis=2)
-
-def combine_label(cv_mat_pro_label):
+def process_label(cv_mat_raw_label):
     "Take in a raw label and return a processed label"
-    # print(cv_mat_pro_label.shape)
-    result_img = (cv_mat_pro_label[:, :, 0] > cv_mat_pro_label[:, :, 1])*255
-    return result_img.astype(np.uint8)
+    return expand_label(encode_label(cv_mat_raw_label))
+
+# Class 0 is drawn white, class 1 black
+_MASK_PALETTE = np.array([255, 0], dtype=np.uint8)
+
+def decode_label(cv_mat_pro_label):
+    "Take in processed labels or predictions and return uint8 class indexes"
+    return (cv_mat_pro_label[..., 0] <= cv_mat_pro_label[..., 1]).view(np.uint8)
+
+def color_label(label_index, out=None):
+    "Take in class indexes and return a mask image, written into out if given"
+    return np.take(_MASK_PALETTE, label_index, out=out, mode='clip')
+
+def combine_label(cv_mat_pro_label, out=None):
+    "Take in processed labels of any leading shape and return mask images"
+    return color_label(decode_label(cv_mat_pro_label), out=out)
 
 def main():
     "Testing"
@@ -0,0 +1,203 @@
+"""Benchmarks every stage of the DataFeeder pipeline on a synthetic data set
+
+Writes machine readable JSON so results can be compared across commits:
+    python -m <package>.benchmark --count 50 --output bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from os import makedirs
+from os.path import join
+
+import cv2
+import numpy as np
+
+if __package__:
+    from . import GeneralDataFeeder
+    from . import ObjClass
+    from . import ObjClass2
+else:
+    import GeneralDataFeeder
+    import ObjClass
+    import ObjClass2
+
+LABEL_CODECS = {"ObjClass": ObjClass, "ObjClass2": ObjClass2}
+
+def make_dataset(data_path, count=20, width=1280, height=1024, label_density=0.05, seed=0):
+    """Writes count random frames with labels painted in the CLASS colors
+
+    label_density is the rough fraction of labelled pixels of each frame"""
+    random_state = np.random.RandomState(seed)
+    img_folder = join(data_path, GeneralDataFeeder.IMAGE_FOLDER)
+    label_folder = join(data_path, GeneralDataFeeder.LABEL_FOLDER)
+    for folder in (img_folder, label_folder):
+        makedirs(folder, exist_ok=True)
+
+    colors = [obj_class.get_bgr() for obj_class in ObjClass.CLASS]
+    for index in range(count):
+        # Smooth noise compresses like a camera frame, unlike white noise
+        img = cv2.resize(random_state.randint(0, 256, (height//16, width//16, 3)).astype(np.uint8),
+                         (width, height))
+        label = np.zeros((height, width, 4), dtype=np.uint8)
+
+        labelled = 0
+        while labelled < label_density * width * height:
+            box_height = random_state.randint(8, max(9, height//8))
+            box_width = random_state.randint(8, max(9, width//8))
+            top = random_state.randint(0, height-box_height)
+            left = random_state.randint(0, width-box_width)
+            color = colors[random_state.randint(len(colors))]
+            label[top:top+box_height, left:left+box_width] = np.append(color, 255)
+            labelled += box_height * box_width
+
+        file_name = "{:06d}.png".format(index)
+        cv2.imwrite(join(img_folder, file_name), img)
+        cv2.imwrite(join(label_folder, file_name), label)
+
+def _time(function, repeats):
+    "Best and mean wall time of repeats calls, and the last result"
+    times = []
+    result = None
+    for _ in range(repeats):
+        start = time.time()
+        result = function()
+        times.append(time.time() - start)
+    return ({"best_seconds": min(times), "mean_seconds": sum(times)/len(times),
+             "repeats": repeats}, result)
+
+def _stage(results, name, function, repeats, items=None):
+    "Times one stage into results, items gives the per second rate"
+    stats, result = _time(function, repeats)
+    if items is not None:
+        stats["items"] = items
+        stats["items_per_second"] = items / max(stats["best_seconds"], 1e-9)
+    results[name] = stats
+    return result
+
+def run(data_path, label_codec=ObjClass2, data_padding=0, label_width=64,
+        batch_size=64, batches=20, repeats=3, workers=1):
+    "Runs every stage on the data set at data_path, returns the results"
+    results = {}
+    feeder_args = dict(data_padding=data_padding, label_width=label_width,
+                       label_codec=label_codec, workers=workers,
+                       missing_cache=GeneralDataFeeder.MISSING_CACHE_BUILD)
+    img_folder = join(data_path, GeneralDataFeeder.IMAGE_FOLDER)
+    label_folder = join(data_path, GeneralDataFeeder.LABEL_FOLDER)
+
+    file_list = _stage(results, "directory_scan",
+                       lambda: GeneralDataFeeder.DataFeeder.get_file_list(img_folder),
+                       repeats)
+
+    def decode():
+        return (np.array([cv2.imread(join(img_folder, name)) for name in file_list]),
+                np.array([cv2.imread(join(label_folder, name), cv2.IMREAD_UNCHANGED)
+                          for name in file_list]))
+    img_data, label_data = _stage(results, "decode", decode, repeats, len(file_list))
+
+    _, label_tiles = _stage(
+        results, "breakdown_n_filter",
+        lambda: GeneralDataFeeder.breakdown_n_filter(img_data, label_data, data_padding,
+                                                     label_width, label_width),
+        repeats, len(file_list))
+
+    pro_label = _stage(results, "process_label",
+                       lambda: label_codec.process_label(label_tiles), repeats, len(label_tiles))
+    _stage(results, "combine_label",
+           lambda: label_codec.combine_label(pro_label), repeats, len(pro_label))
+    # Free the decoded frames before the cache stages
+    img_data = label_data = label_tiles = pro_label = None
+
+    # DataFeeder prints progress, keep it out of the JSON on stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        for cache_format in GeneralDataFeeder.CACHE_FORMATS:
+            cache_name = "bench_" + cache_format
+
+            def build():
+                feeder = GeneralDataFeeder.DataFeeder(
+                    data_path, cache_name=cache_name, dynamic_load=True,
+                    cache_format=cache_format, **feeder_args)
+                feeder.build_cache()
+            _stage(results, "cache_save_" + cache_format, build, 1, len(file_list))
+
+            feeder = _stage(results, "cache_load_" + cache_format,
+                            lambda: GeneralDataFeeder.DataFeeder(
+                                data_path, cache_name=cache_name,
+                                cache_format=cache_format, **feeder_args),
+                            repeats)
+            _stage(results, "get_batch_static_" + cache_format,
+                   lambda: [feeder.get_batch(batch_size, shuffle=True) for _ in range(batches)],
+                   repeats, batch_size*batches)
+
+        for prefetch_workers in (0, 2):
+            with GeneralDataFeeder.DataFeeder(data_path, dynamic_load=True,
+                                              prefetch_workers=prefetch_workers,
+                                              **feeder_args) as feeder:
+                _stage(results, "get_batch_dynamic_prefetch_{}".format(prefetch_workers),
+                       lambda: [feeder.get_batch(batch_size, shuffle=True)
+                                for _ in range(batches)],
+                       repeats, batch_size*batches)
+
+        with GeneralDataFeeder.DataFeeder(data_path, dynamic_load=True, worker_processes=2,
+                                          **feeder_args) as feeder:
+            _stage(results, "get_batch_dynamic_processes_2",
+                   lambda: [feeder.get_batch(batch_size, shuffle=True) for _ in range(batches)],
+                   repeats, batch_size*batches)
+
+    return results
+
+def main():
+    "Command line entry point"
+    parser = argparse.ArgumentParser(description="Benchmark the DataFeeder pipeline")
+    parser.add_argument("--data-path", default=None,
+                        help="existing data set, a synthetic one is generated by default")
+    parser.add_argument("--count", type=int, default=20, help="synthetic frames")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--label-density", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label-codec", default="ObjClass2", choices=sorted(LABEL_CODECS))
+    parser.add_argument("--data-padding", type=int, default=0)
+    parser.add_argument("--label-width", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--output", default=None, help="JSON file, stdout by default")
+    args = parser.parse_args()
+
+    temp_path = None
+    data_path = args.data_path
+    if data_path is None:
+        temp_path = tempfile.mkdtemp(prefix="feeder_bench_")
+        data_path = temp_path
+        make_dataset(data_path, args.count, args.width, args.height,
+                     args.label_density, args.seed)
+    try:
+        stages = run(data_path, LABEL_CODECS[args.label_codec], args.data_padding,
+                     args.label_width, args.batch_size, args.batches, args.repeats,
+                     args.workers)
+    finally:
+        if temp_path is not None:
+            shutil.rmtree(temp_path)
+
+    report = {
+        "config": vars(args),
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "opencv": cv2.__version__, "machine": platform.machine()},
+        "stages": stages,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
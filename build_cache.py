@@ -0,0 +1,102 @@
+"""Builds a DataFeeder cache from the command line, without any prompt
+
+Run it as python -m <package>.build_cache data/ --workers 8, with <package>
+the name this folder is imported under, or as python build_cache.py from
+inside the folder.
+"""
+import argparse
+import time
+from importlib import import_module
+from os.path import join
+
+if __package__:
+    from . import GeneralDataFeeder
+else:
+    import GeneralDataFeeder
+
+LABEL_CODECS = ("ObjClass", "ObjClass2")
+
+# Seconds between two throughput reports
+REPORT_INTERVAL = 5.0
+
+class ThroughputReport(object):
+    "Progress callback for DataFeeder.build_cache printing files/s, tiles/s and MB/s"
+
+    def __init__(self, total_files, interval=REPORT_INTERVAL):
+        self._total_files = total_files
+        self._interval = interval
+        self._start = time.time()
+        self._last_report = self._start
+        self.files = 0
+        self.reused = 0
+        self.tiles = 0
+        self.bytes = 0
+
+    def __call__(self, entry, decoded):
+        self.files += 1
+        self.tiles += entry["tiles"]
+        if decoded:
+            self.bytes += sum(entry["size"])
+        else:
+            self.reused += 1
+
+        now = time.time()
+        if now - self._last_report >= self._interval:
+            self._last_report = now
+            print(self.summary())
+
+    def summary(self):
+        "One line report of the progress so far"
+        elapsed = max(time.time() - self._start, 1e-9)
+        return ("{}/{} files ({} reused), {} tiles, "
+                "{:.1f} files/s, {:.1f} tiles/s, {:.1f} MB/s").format(
+                    self.files, self._total_files, self.reused, self.tiles,
+                    self.files/elapsed, self.tiles/elapsed, self.bytes/elapsed/2**20)
+
+def _label_codec(name):
+    if __package__:
+        return import_module("."+name, __package__)
+    return import_module(name)
+
+def main():
+    "Command line entry point"
+    parser = argparse.ArgumentParser(description="Build the tile cache of a data set")
+    parser.add_argument("data_path", help="folder holding raw_img/ and label/")
+    parser.add_argument("--cache-name", default="cache")
+    parser.add_argument("--cache-format", default=GeneralDataFeeder.CACHE_FORMAT_NPZ,
+                        choices=GeneralDataFeeder.CACHE_FORMATS)
+    parser.add_argument("--data-padding", type=int, default=0)
+    parser.add_argument("--label-width", type=int, default=64)
+    parser.add_argument("--label-height", type=int, default=None,
+                        help="defaults to the label width")
+    parser.add_argument("--label-codec", default="ObjClass2", choices=LABEL_CODECS)
+    parser.add_argument("--target-size", type=int, nargs=2, default=None,
+                        metavar=("WIDTH", "HEIGHT"),
+                        help="decode frames and labels at this size")
+    parser.add_argument("--min-label-pixels", type=int, default=1,
+                        help="labelled pixels a tile needs to be cached")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="decoding processes, defaults to the number of cores")
+    parser.add_argument("--shard-size", type=int, default=GeneralDataFeeder.SHARD_SIZE,
+                        help="tiles per shard of a sharded cache")
+    parser.add_argument("--report-interval", type=float, default=REPORT_INTERVAL,
+                        help="seconds between throughput reports")
+    args = parser.parse_args()
+
+    # Nothing is loaded up front in dynamic mode, build_cache does the work
+    feeder = GeneralDataFeeder.DataFeeder(
+        args.data_path, cache_name=args.cache_name, dynamic_load=True,
+        data_padding=args.data_padding, label_width=args.label_width,
+        label_height=args.label_height, cache_format=args.cache_format,
+        workers=args.workers, label_codec=_label_codec(args.label_codec),
+        shard_size=args.shard_size, target_size=args.target_size,
+        min_label_pixels=args.min_label_pixels,
+        missing_cache=GeneralDataFeeder.MISSING_CACHE_BUILD)
+
+    file_count = len(feeder.get_file_list(join(args.data_path, GeneralDataFeeder.IMAGE_FOLDER)))
+    report = ThroughputReport(file_count, args.report_interval)
+    feeder.build_cache(progress=report)
+    print(report.summary())
+
+if __name__ == "__main__":
+    main()
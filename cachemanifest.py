@@ -0,0 +1,61 @@
+"""Bookkeeping of which files, and which settings, a cache was built from"""
+import hashlib
+import json
+from os import replace
+
+# Bump when the layout of cached tiles, or which files they come from, changes
+CACHE_VERSION = 2
+
+MANIFEST_EXT = ".manifest.json"
+
+def content_digest(img_bytes, label_bytes):
+    "Returns the hash of the content of an image, label pair"
+    digest = hashlib.sha1()
+    digest.update(img_bytes)
+    digest.update(label_bytes)
+    return digest.hexdigest()
+
+def file_digest(image_path, label_path):
+    "content_digest of an image, label pair on disk"
+    with open(image_path, "rb") as img_file, open(label_path, "rb") as label_file:
+        return content_digest(img_file.read(), label_file.read())
+
+def read_manifest(path):
+    "Returns the manifest at path, None if it does not exist"
+    try:
+        with open(path, "r") as manifest_file:
+            return json.load(manifest_file)
+    except IOError as error:
+        if error.errno == 2: # No such file or directory
+            return None
+        raise error
+
+def write_manifest(path, fingerprint, entries):
+    "Writes the manifest of a cache, entries are in cache order"
+    tmp_path = path+".tmp"
+    with open(tmp_path, "w") as manifest_file:
+        json.dump({"fingerprint": fingerprint, "files": entries}, manifest_file)
+    replace(tmp_path, path)
+
+def manifest_offsets(manifest):
+    "Maps file names to (entry, first tile, tile count) of the cached arrays"
+    offsets = {}
+    start = 0
+    for entry in manifest["files"]:
+        offsets[entry["name"]] = (entry, start, entry["tiles"])
+        start += entry["tiles"]
+    return offsets
+
+def is_stale(manifest, fingerprint, file_states):
+    """Whether a cache no longer matches the files and settings
+
+    file_states lists (name, sizes, mtimes) of the files on disk, in order"""
+    if manifest is None or manifest["fingerprint"] != fingerprint:
+        return True
+    entries = manifest["files"]
+    if len(entries) != len(file_states):
+        return True
+    for entry, (name, sizes, mtimes) in zip(entries, file_states):
+        if entry["name"] != name or entry["size"] != sizes or entry["mtime"] != mtimes:
+            return True
+    return False
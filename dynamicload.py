@@ -0,0 +1,243 @@
+"""Tile loading of dynamic_load, files are decoded and tiled into the
+TileReservoir by the prefetch threads, or inside get_batch without them"""
+from os.path import join
+from threading import Thread
+
+import numpy as np
+
+if __package__:
+    from . import labelindex
+    from .tiling import (IMAGE_FOLDER, LABEL_FOLDER, decode_image, decode_label, kept_tiles,
+                         read_ahead)
+else:
+    import labelindex
+    from tiling import (IMAGE_FOLDER, LABEL_FOLDER, decode_image, decode_label, kept_tiles,
+                        read_ahead)
+
+LOAD_N_IMAGES_AT_A_TIME = 10
+
+# Seconds between checks for close() while blocked on the reservoir
+PREFETCH_POLL_INTERVAL = 0.1
+
+class DynamicLoader(object):
+    """Producer side of dynamic_load, a base class of DataFeeder
+
+    Works on the sampler, reservoir, label index, frame cache and settings
+    that DataFeeder sets up. The reservoir, label index, frame cache, folder
+    listings and stats lock their own state, so the prefetch threads share
+    them as they are"""
+
+    def _load_tiles(self, shuffle, slient=True):
+        """Loads the next LOAD_N_IMAGES_AT_A_TIME files and returns their tiles
+
+        Also returns the epoch of every tile and of the last file drawn"""
+        self._discover_files()
+        raw_img_folder_path = join(self._data_path, IMAGE_FOLDER)
+        label_folder_path = join(self._data_path, LABEL_FOLDER)
+
+        # Frames grouped by (image shape, label shape), each group is tiled
+        # with one breakdown_n_filter call
+        buckets = {}
+
+        # All files of a refill are drawn at once, so every prefetch thread
+        # reads its own run of files
+        indexes, file_epochs = self._get_file_indexes(shuffle, LOAD_N_IMAGES_AT_A_TIME)
+        last_epoch = int(file_epochs[-1])
+
+        cache = self._frame_cache
+        if cache is not None:
+            # Without shuffling files come back in the same order every
+            # epoch, an LRU would evict each one right before its next use
+            cache.evict = shuffle
+
+        img_data = []
+        p_label_data = []
+        tile_epochs = []
+        files = []
+        for index, file_epoch in zip(indexes, file_epochs):
+            file_name = self._file_list[index]
+            entry = self._label_index.get(file_name) if self._use_label_index else None
+            if entry is not None and not entry["tiles"]:
+                self._stats.count("files_skipped")
+                continue
+            cached = None if cache is None else cache.get(file_name)
+            if cached is not None and self._frame_cache_tiles:
+                img_data.append(cached[0])
+                p_label_data.append(cached[1])
+                tile_epochs.append(np.full(len(cached[0]), file_epoch))
+            else:
+                files.append((file_name, entry, file_epoch, cached))
+
+        if self._read_ahead:
+            # Labels and images of the refill are requested together
+            read_ahead([join(folder, file_name) for file_name, _, _, cached in files
+                        if cached is None
+                        for folder in (label_folder_path, raw_img_folder_path)])
+
+        for file_name, entry, file_epoch, cached in files:
+            if cached is not None:
+                t_img_data, t_label_data = cached
+                self._add_to_bucket(buckets, file_name, t_img_data, t_label_data, file_epoch)
+                continue
+
+            # The label goes first, images without a tile to keep are never read
+            label_file_path = join(label_folder_path, file_name)
+            with self._stats.timed("read_label"):
+                t_label_data = self._read_image(label_file_path, decode_label)
+            with self._stats.timed("label_preprocess"):
+                t_label_data = self._label_preprocess(t_label_data)
+            # With label_batch_preprocess kept tiles are only known once tiled
+            if entry is None and not self._labels_batched:
+                tiles = kept_tiles(t_label_data, self._data_padding, self._label_height,
+                                   self._label_width, self._min_label_pixels)
+                if self._use_label_index:
+                    self._label_index.record(file_name, labelindex.make_entry(
+                        label_file_path, t_label_data.shape, tiles))
+                if not tiles:
+                    self._stats.count("files_skipped")
+                    continue
+
+            img_file_path = join(raw_img_folder_path, file_name)
+            with self._stats.timed("read_image"):
+                t_img_data = self._read_image(img_file_path, decode_image)
+            with self._stats.timed("raw_preprocess"):
+                t_img_data = self._raw_preprocess(t_img_data)
+            self._stats.count("files_loaded")
+            if cache is not None and not self._frame_cache_tiles:
+                cache.put(file_name, (t_img_data, t_label_data))
+
+            self._add_to_bucket(buckets, file_name, t_img_data, t_label_data, file_epoch)
+            if not slient:
+                print("Loading", file_name)
+
+        for b_img_data, b_label_data, b_epochs, b_names in buckets.values():
+            with self._stats.timed("raw_batch_preprocess"):
+                b_img_data = self._raw_batch_preprocess(np.array(b_img_data))
+            with self._stats.timed("label_batch_preprocess"):
+                b_label_data = self._label_batch_preprocess(np.array(b_label_data))
+            b_img_data, b_label_data, frames = self._breakdown_n_filter(
+                b_img_data, b_label_data, True)
+            with self._stats.timed("label_encoding"):
+                b_p_label_data = self._label_codec.compact_label(b_label_data)
+            if cache is not None and self._frame_cache_tiles:
+                for frame, file_name in enumerate(b_names):
+                    in_frame = frames == frame
+                    cache.put(file_name, (b_img_data[in_frame], b_p_label_data[in_frame]))
+            img_data.append(b_img_data)
+            p_label_data.append(b_p_label_data)
+            tile_epochs.append(np.array(b_epochs)[frames])
+
+        if not img_data:
+            return ([], [], [], last_epoch)
+        img_data = np.concatenate(img_data)
+        if self._batch_preprocess_on_workers:
+            with self._stats.timed("tile_batch_preprocess"):
+                img_data = self._tile_batch_preprocess(img_data)
+        return (img_data, np.concatenate(p_label_data),
+                np.concatenate(tile_epochs), last_epoch)
+
+    @staticmethod
+    def _add_to_bucket(buckets, file_name, img_data, label_data, epoch):
+        "Groups frames by (image shape, label shape) for _load_tiles"
+        bucket = buckets.setdefault((img_data.shape, label_data.shape), ([], [], [], []))
+        bucket[0].append(img_data)
+        bucket[1].append(label_data)
+        bucket[2].append(epoch)
+        bucket[3].append(file_name)
+
+    def _read_image(self, path, decode):
+        "Reads the file at path and decodes it with decode_image or decode_label"
+        with open(path, "rb") as image_file:
+            return decode(image_file.read(), self._target_size)
+
+    def _refill(self, shuffle, slient):
+        "Loads tiles into the reservoir without prefetch threads"
+        img_data, p_label_data, tile_epochs, last_epoch = self._load_tiles(shuffle, slient)
+        self._reservoir.put(img_data, p_label_data, tile_epochs)
+        self._producer_epochs[0] = last_epoch
+
+    def _start_prefetch(self, shuffle, slient):
+        "Starts the producer threads on the first dynamic get_batch"
+        if self._prefetch_threads:
+            assert self._prefetch_shuffle == shuffle, \
+                "shuffle can not change while prefetching, close() the DataFeeder first"
+            return
+
+        self._prefetch_shuffle = shuffle
+        self._prefetch_stop.clear()
+        self._prefetch_error = None
+        self._producer_epochs = [self._sampler.epoch] * self._prefetch_workers
+
+        for producer in range(self._prefetch_workers):
+            thread = Thread(target=self._prefetch_loop, args=(producer, shuffle, slient))
+            thread.daemon = True
+            thread.start()
+            self._prefetch_threads.append(thread)
+
+    def _prefetch_loop(self, producer, shuffle, slient):
+        "Producer thread, keeps the reservoir filled"
+        try:
+            while not self._prefetch_stop.is_set():
+                img_data, p_label_data, tile_epochs, last_epoch = self._load_tiles(shuffle, slient)
+                with self._stats.timed("buffer_put"):
+                    put = self._reservoir.put(img_data, p_label_data, tile_epochs,
+                                              self._prefetch_stop, PREFETCH_POLL_INTERVAL)
+                # Only once every tile drawn so far is in the reservoir
+                if put:
+                    self._producer_epochs[producer] = last_epoch
+        except Exception as error: # pylint: disable=W0703
+            # Handed to the consumer, which re-raises it from get_batch
+            self._prefetch_error = error
+            self._prefetch_stop.set()
+
+    def _take_tiles(self, size, shuffle, slient, epoch=None, img_out=None):
+        """Draws size tiles out of the reservoir, loading more as needed
+
+        Returns their images and compact labels. Given an epoch only tiles of
+        that epoch or older are drawn, and fewer than size are returned once
+        the epoch is used up, that is once every producer drew a file of a
+        later epoch and no tile of it is left"""
+        random_state = self._tile_random_state if shuffle else None
+        if self._prefetch_workers == 0:
+            # Without prefetching the consumer waits for the refills. When
+            # shuffling half the capacity is kept loaded so batches mix
+            # several chunks, in order one batch is enough
+            loaded = size
+            if shuffle:
+                loaded = max(size, self._reservoir.capacity // 2)
+            while len(self._reservoir) < loaded:
+                if epoch is not None and self._producer_epochs[0] > epoch:
+                    break
+                self._refill(shuffle, slient)
+
+        chunks = []
+        filled = 0
+        while filled < size:
+            # Read before taking, producers move on only after their put
+            used_up = epoch is not None and min(self._producer_epochs) > epoch
+            taken = self._reservoir.take(size - filled, random_state, epoch)
+            if taken is not None:
+                chunks.append(taken)
+                filled += len(taken[0])
+            elif used_up:
+                break
+            elif self._prefetch_workers == 0:
+                self._refill(shuffle, slient)
+            else:
+                if self._prefetch_error is not None:
+                    raise self._prefetch_error
+                if self._prefetch_stop.is_set():
+                    raise RuntimeError("DataFeeder prefetching was stopped")
+                if epoch is not None and len(self._reservoir) >= self._reservoir.capacity:
+                    # Full of later epochs, make room for what is left of this one
+                    self._reservoir.grow()
+                self._reservoir.wait(PREFETCH_POLL_INTERVAL)
+
+        if not chunks:
+            return ([], [])
+        img_data, label_data, epochs = [np.concatenate(arrays) for arrays in zip(*chunks)]
+        if img_out is not None:
+            np.copyto(img_out, img_data)
+            img_data = img_out
+        self._consumer_epoch = max(self._consumer_epoch, int(epochs.max()))
+        return (img_data, label_data)
@@ -0,0 +1,91 @@
+"""Per stage timing and counters of a DataFeeder"""
+import time
+from collections import deque
+from threading import Lock
+
+# Number of latest timings the recent averages are taken over
+RECENT_WINDOW = 100
+
+class _NullTimer(object):
+    "Timer handed out while stats are disabled, does nothing"
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer(object):
+    def __init__(self, stats, stage):
+        self._stats = stats
+        self._stage = stage
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self._stats.add_time(self._stage, time.time() - self._start)
+        return False
+
+class FeederStats(object):
+    """Cumulative and recent wall time per stage, and event counters
+
+    When disabled every call returns right away, so instrumented code pays
+    about one method call"""
+
+    def __init__(self, enabled=False, recent_window=RECENT_WINDOW):
+        self.enabled = enabled
+        self._recent_window = recent_window
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        "Clears every timing and counter"
+        with self._lock:
+            self._calls = {}
+            self._total = {}
+            self._recent = {}
+            self._counters = {}
+
+    def timed(self, stage):
+        "Context manager adding the time spent inside to stage"
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def add_time(self, stage, seconds):
+        "Adds seconds spent in stage"
+        if not self.enabled:
+            return
+        with self._lock:
+            if stage not in self._calls:
+                self._calls[stage] = 0
+                self._total[stage] = 0.0
+                self._recent[stage] = deque(maxlen=self._recent_window)
+            self._calls[stage] += 1
+            self._total[stage] += seconds
+            self._recent[stage].append(seconds)
+
+    def count(self, counter, amount=1):
+        "Adds amount to counter"
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    def snapshot(self):
+        "Returns the stats as plain dicts"
+        with self._lock:
+            stages = {}
+            for stage in self._calls:
+                recent = self._recent[stage]
+                stages[stage] = {
+                    "calls": self._calls[stage],
+                    "total_seconds": self._total[stage],
+                    "mean_seconds": self._total[stage] / self._calls[stage],
+                    "recent_mean_seconds": sum(recent) / len(recent),
+                }
+            return {"stages": stages, "counters": dict(self._counters)}
@@ -0,0 +1,98 @@
+"""Listing of the data set folders, remembered across runs
+
+A folder is only listed again once its mtime changes, which happens
+whenever a file is added, removed or renamed in it. Listings only hold
+file names, a file rewritten in place leaves its folder mtime alone, so
+sizes and mtimes are always read fresh, see scan_folder."""
+import json
+import time
+from os import replace, scandir, stat
+from os.path import join
+from threading import Lock
+
+FILE_MANIFEST = "file_manifest.json"
+
+# Changes within this many seconds of a scan may share its mtime, such a
+# listing is not trusted
+RACY_SECONDS = 2.0
+
+def file_names(path):
+    "Names of the files in the folder at path, without a stat of each"
+    return [entry.name for entry in scandir(path) if entry.is_file()]
+
+def scan_folder(path):
+    "Returns {name: [size, mtime]} of the files in the folder at path"
+    files = {}
+    for entry in scandir(path):
+        if entry.is_file():
+            entry_stat = entry.stat()
+            files[entry.name] = [entry_stat.st_size, entry_stat.st_mtime]
+    return files
+
+def read_manifest(path):
+    "Returns the folder listings saved at path, {} if there are none"
+    try:
+        with open(path, "r") as manifest_file:
+            return json.load(manifest_file)
+    except IOError as error:
+        if error.errno == 2: # No such file or directory
+            return {}
+        raise error
+    except ValueError:
+        # Cut short by a crash, scan again
+        return {}
+
+def write_manifest(path, folders):
+    "Saves the folder listings atomically, silently skipped on read only data sets"
+    try:
+        with open(path+".tmp", "w") as manifest_file:
+            json.dump(folders, manifest_file)
+        replace(path+".tmp", path)
+    except (IOError, OSError):
+        pass
+
+def list_folder(path, listing=None):
+    """Returns the listing of the folder at path and whether it was scanned
+
+    listing is the last one of this folder, reused when the folder did not
+    change since. A listing is a dict with the folder mtime, the scan time
+    and the sorted file names"""
+    mtime = stat(path).st_mtime
+    if (listing is not None and listing["mtime"] == mtime
+            and listing["scanned"] - mtime > RACY_SECONDS):
+        return (listing, False)
+    scanned = time.time()
+    return ({"mtime": mtime, "scanned": scanned, "files": sorted(file_names(path))}, True)
+
+class DataSetListing(object):
+    "Listings of the folders of a data set, saved in its file manifest"
+
+    def __init__(self, data_path, folders):
+        self._data_path = data_path
+        self._folders = folders
+        self._manifest_path = join(data_path, FILE_MANIFEST)
+        self._listings = None
+        self._lock = Lock()
+
+    def scan(self):
+        """Returns the sorted file names of every folder
+
+        Only folders whose mtime changed are scanned again"""
+        file_lists = []
+        with self._lock:
+            if self._listings is None:
+                self._listings = read_manifest(self._manifest_path)
+            scanned = False
+            for folder in self._folders:
+                listing, folder_scanned = list_folder(join(self._data_path, folder),
+                                                      self._listings.get(folder))
+                self._listings[folder] = listing
+                scanned = scanned or folder_scanned
+                file_lists.append(sorted(listing["files"]))
+            if scanned:
+                write_manifest(self._manifest_path, self._listings)
+        return file_lists
+
+    def file_states(self, folder):
+        "{name: [size, mtime]} of the files in folder, read now, see scan_folder"
+        return scan_folder(join(self._data_path, folder))
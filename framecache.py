@@ -0,0 +1,55 @@
+"""In memory cache of decoded frames, bounded by a byte budget"""
+from collections import OrderedDict
+from threading import Lock
+
+class FrameCache(object):
+    """Arrays of decoded files by file name, least recently used first out
+
+    Entries are tuples of numpy arrays, and count for their nbytes against
+    max_bytes. Without evict nothing is evicted and entries that do not fit
+    are not kept: a file list scanned in the same order every epoch makes
+    an LRU evict every entry just before it is needed again."""
+
+    def __init__(self, max_bytes, evict=True):
+        self.max_bytes = max_bytes
+        self.evict = evict
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        "Returns the entry of key, None if it is not cached"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, arrays):
+        "Caches arrays under key, evicting old entries as needed"
+        size = sum(array.nbytes for array in arrays)
+        with self._lock:
+            if key in self._entries or size > self.max_bytes:
+                return
+            if self.evict:
+                while self._bytes + size > self.max_bytes:
+                    _, (_, old_size) = self._entries.popitem(last=False)
+                    self._bytes -= old_size
+            elif self._bytes + size > self.max_bytes:
+                return
+            self._entries[key] = (arrays, size)
+            self._bytes += size
+
+    def stats(self):
+        "Hits, misses and use of the budget as a dict"
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries),
+                    "bytes": self._bytes, "max_bytes": self.max_bytes}
@@ -0,0 +1,56 @@
+"""Image size from the PNG or JPEG header, without decoding the image"""
+import struct
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SOI = b"\xff\xd8"
+
+# Start of frame markers, every 0xC0-0xCF marker but DHT, JPG and DAC
+_JPEG_SOF = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length field
+_JPEG_STANDALONE = frozenset(range(0xD0, 0xDA)) | {0x01}
+
+def image_size(image_file):
+    """Returns the (width, height) of the image read from image_file
+
+    Only reads the header. Returns None for formats other than PNG and
+    JPEG, or when the header is cut short"""
+    start = image_file.read(len(PNG_SIGNATURE))
+    if start == PNG_SIGNATURE:
+        chunk = image_file.read(16)
+        if len(chunk) < 16 or chunk[4:8] != b"IHDR":
+            return None
+        return struct.unpack(">II", chunk[8:16])
+    if start[:2] == JPEG_SOI:
+        return _jpeg_size(image_file, start[2:])
+    return None
+
+def _jpeg_size(image_file, data):
+    "Walks the JPEG segments up to the first start of frame"
+    while True:
+        data += image_file.read(max(0, 4 - len(data)))
+        if len(data) < 2 or data[0] != 0xFF:
+            return None
+        marker = data[1]
+        if marker == 0xFF:
+            # Fill byte before the marker
+            data = data[1:]
+            continue
+        if marker in _JPEG_STANDALONE:
+            data = data[2:]
+            continue
+        if len(data) < 4:
+            return None
+        length = struct.unpack(">H", data[2:4])[0]
+        if marker in _JPEG_SOF:
+            frame = data[4:] + image_file.read(max(0, 5 - len(data[4:])))
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack(">HH", frame[1:5])
+            return (width, height)
+        # Skip the segment, the length counts its own two bytes
+        skip = length - 2 - len(data[4:])
+        if skip < 0:
+            data = data[4+length-2:]
+        else:
+            image_file.seek(skip, 1)
+            data = b""
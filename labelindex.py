@@ -0,0 +1,116 @@
+"""Index of which tiles of every file have labelled pixels
+
+Kept next to the data set so frames with empty labels are never decoded
+again, by later epochs or by cache builds. Entries are tied to the size
+and mtime of the label file and to the tiling settings."""
+import json
+import tempfile
+from os import chmod, fdopen, remove, replace, stat
+from os.path import dirname
+from threading import Lock
+
+LABEL_INDEX_FILE = "label_index.json"
+
+def label_state(label_path):
+    "Returns the [size, mtime] of a label file"
+    label_stat = stat(label_path)
+    return [label_stat.st_size, label_stat.st_mtime]
+
+def make_entry(label_path, shape, tiles):
+    """Index entry of a label file of shape (height, width, ...)
+
+    tiles lists the (y, x) grid positions of the tiles that are kept"""
+    return {"state": label_state(label_path), "shape": list(shape[:2]),
+            "tiles": [list(tile) for tile in tiles]}
+
+def read_index(path, settings):
+    "Returns the entries of the index at path, {} if missing or made with other settings"
+    try:
+        with open(path, "r") as index_file:
+            index = json.load(index_file)
+    except IOError as error:
+        if error.errno == 2: # No such file or directory
+            return {}
+        raise error
+    if index["settings"] != settings:
+        return {}
+    return index["files"]
+
+def write_index(path, settings, entries):
+    """Writes the index atomically, silently skipped on read only data sets
+
+    Every writer has its own temporary file, ranks sharing the data set
+    never replace each other's"""
+    try:
+        handle, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=dirname(path) or ".")
+    except (IOError, OSError):
+        return
+    try:
+        with fdopen(handle, "w") as index_file:
+            json.dump({"settings": settings, "files": entries}, index_file)
+        # mkstemp files are private to their owner
+        chmod(tmp_path, 0o644)
+        replace(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            remove(tmp_path)
+        except OSError:
+            pass
+
+def valid_entries(entries, label_states):
+    """Entries whose label file is unchanged
+
+    label_states maps the file names to check to the [size, mtime] of
+    their label file, as read by filescan.scan_folder"""
+    valid = {}
+    for file_name, state in label_states.items():
+        entry = entries.get(file_name)
+        if entry is not None and entry["state"] == state:
+            valid[file_name] = entry
+    return valid
+
+class LabelIndex(object):
+    """Label index of one data set, kept in memory
+
+    Recorded entries are saved every save_interval of them, and by save()."""
+
+    def __init__(self, path, settings, save_interval):
+        self.path = path
+        self.settings = settings
+        self._save_interval = save_interval
+        self._entries = {}
+        self._unsaved = 0
+        self._lock = Lock()
+
+    def load(self, label_states):
+        "Takes the saved entries still valid for label_states, see valid_entries"
+        entries = valid_entries(read_index(self.path, self.settings), label_states)
+        with self._lock:
+            self._entries = entries
+            self._unsaved = 0
+
+    def get(self, file_name):
+        "Entry of file_name, None if it is not indexed"
+        return self._entries.get(file_name)
+
+    def empty_files(self):
+        "Names of the indexed files without any kept tile"
+        with self._lock:
+            return frozenset(file_name for file_name, entry in self._entries.items()
+                             if not entry["tiles"])
+
+    def record(self, file_name, entry):
+        "Adds the entry of a file, see make_entry"
+        with self._lock:
+            self._entries[file_name] = entry
+            self._unsaved += 1
+            due = self._unsaved >= self._save_interval
+        if due:
+            self.save()
+
+    def save(self):
+        "Writes the index if any entry was recorded since the last save"
+        with self._lock:
+            if self._unsaved > 0:
+                write_index(self.path, self.settings, self._entries)
+                self._unsaved = 0
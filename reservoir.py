@@ -0,0 +1,127 @@
+"""Preallocated reservoir of tiles that dynamic_load batches are drawn from"""
+from threading import Condition
+
+import numpy as np
+
+class TileReservoir(object):
+    """Tiles and the epoch of their file, held in preallocated arrays
+
+    The arrays are a ring, rows run from the head for count rows, wrapping
+    around the end. Blocks of tiles are copied in with slice assignments.
+    take() gathers rows with one fancy index, at random or oldest first.
+    Oldest first takes move the head on, random ones fill their holes
+    with the last rows, neither moves the other rows."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._count = 0
+        self._head = 0
+        # Image tiles, compact labels and epochs, allocated on the first put
+        self._arrays = None
+        self._condition = Condition()
+
+    def __len__(self):
+        return self._count
+
+    def _rows(self, positions):
+        "Array rows of positions counted from the head"
+        return (self._head + positions) % self.capacity
+
+    def _allocate(self, capacity, blocks):
+        arrays = [np.empty((capacity,) + block.shape[1:], block.dtype) for block in blocks]
+        if self._arrays is not None:
+            rows = self._rows(np.arange(self._count))
+            for array, old_array in zip(arrays, self._arrays):
+                array[:self._count] = old_array[rows]
+        self._arrays = arrays
+        self._head = 0
+        self.capacity = capacity
+
+    def grow(self):
+        "Doubles the capacity, so producers blocked on a full reservoir can go on"
+        with self._condition:
+            if self._arrays is not None:
+                self._allocate(self.capacity * 2, self._arrays)
+            self._condition.notify_all()
+
+    def put(self, img_data, label_data, epochs, stop=None, timeout=0.1):
+        """Copies tiles in, waiting for room while the reservoir is full
+
+        Without a stop Event the reservoir grows instead of waiting. Returns
+        False when stop was set before every tile was put"""
+        blocks = (np.asarray(img_data), np.asarray(label_data), np.asarray(epochs))
+        start = 0
+        with self._condition:
+            while start < len(blocks[0]):
+                if self._arrays is None:
+                    self._allocate(max(self.capacity, len(blocks[0])), blocks)
+                room = self.capacity - self._count
+                if room == 0:
+                    if stop is None:
+                        self._allocate(self._count + len(blocks[0]) - start, self._arrays)
+                        continue
+                    if stop.is_set():
+                        return False
+                    self._condition.wait(timeout)
+                    continue
+
+                # Up to the end of the arrays, the rest wraps around next time
+                tail = (self._head + self._count) % self.capacity
+                count = min(room, len(blocks[0]) - start, self.capacity - tail)
+                for array, block in zip(self._arrays, blocks):
+                    array[tail:tail+count] = block[start:start+count]
+                self._count += count
+                start += count
+                self._condition.notify_all()
+        return True
+
+    def wait(self, timeout):
+        "Waits up to timeout seconds for a put or take"
+        with self._condition:
+            self._condition.wait(timeout)
+
+    def take(self, count, random_state=None, max_epoch=None):
+        """Removes up to count tiles, returns their (images, compact labels, epochs)
+
+        Tiles are drawn with random_state, or oldest first without one.
+        Given max_epoch only tiles of that epoch or older are taken. Returns
+        None when there is no such tile, never waits"""
+        with self._condition:
+            if self._count == 0:
+                return None
+            # Positions counted from the head
+            if max_epoch is None:
+                candidates = np.arange(self._count)
+            else:
+                epochs = self._arrays[2][self._rows(np.arange(self._count))]
+                candidates = np.nonzero(epochs <= max_epoch)[0]
+            count = min(count, len(candidates))
+            if count == 0:
+                return None
+
+            if random_state is None:
+                positions = candidates[:count]
+            else:
+                positions = random_state.choice(candidates, count, replace=False)
+            taken = [np.take(array, self._rows(positions), axis=0) for array in self._arrays]
+
+            left = self._count - count
+            if random_state is None:
+                # Rows skipped for being of a later epoch move up behind
+                # the taken ones, in order, before the head moves past them
+                last = positions[-1] + 1
+                if last > count:
+                    kept = np.setdiff1d(np.arange(last), positions, assume_unique=True)
+                    for array in self._arrays:
+                        array[self._rows(np.arange(count, last))] = array[self._rows(kept)]
+                self._head = (self._head + count) % self.capacity
+            else:
+                # Move the last rows into the holes
+                holes = positions[positions < left]
+                movers = np.setdiff1d(np.arange(left, self._count), positions,
+                                      assume_unique=True)
+                for array in self._arrays:
+                    array[self._rows(holes)] = array[self._rows(movers)]
+            self._count = left
+            self._condition.notify_all()
+        return taken
@@ -0,0 +1,103 @@
+"""Epoch based sampling of data indexes"""
+import numpy as np
+
+class EpochSampler(object):
+    """Hands out every index of an epoch exactly once
+
+    Each epoch is a permutation of range(size) seeded by seed + epoch, or
+    range(size) itself when not shuffling. The epoch is cut into world_size
+    equal contiguous parts and only part rank is handed out, so every
+    process of a data-parallel job sees a disjoint share of the data.
+    The size % world_size indexes left over are skipped for that epoch.
+
+    With a block_size above 1 shuffling permutes runs of block_size
+    consecutive indexes instead, keeping each run in order, so files are
+    read close to sequentially."""
+
+    def __init__(self, size, seed=None, rank=0, world_size=1, block_size=1):
+        assert 0 <= rank < world_size, "rank must be in [0, world_size)"
+        if seed is None:
+            assert world_size == 1, "seed is required so every rank draws the same permutation"
+            seed = np.random.randint(2**31)
+
+        self._size = size
+        # Size taken on at the start of the next epoch, see resize
+        self._next_size = size
+        self.seed = seed
+        self._rank = rank
+        self._world_size = world_size
+        self._block_size = block_size
+
+        self.epoch = 0
+        self._position = 0
+        self._order = None
+        self._order_key = None
+
+    def __len__(self):
+        "Number of indexes handed out per epoch"
+        return self._size // self._world_size
+
+    def remaining(self):
+        "Number of indexes left in the current epoch"
+        return len(self) - self._position
+
+    def index_epochs(self, count):
+        "Epochs the next count indexes belong to"
+        # Later epochs are cut from the resized range
+        next_len = self._next_size // self._world_size
+        later = np.arange(count) - self.remaining()
+        return self.epoch + np.where(later < 0, 0, 1 + later // max(next_len, 1))
+
+    def resize(self, size):
+        """Hands out range(size) from the next epoch on
+
+        The current epoch is finished with the old size, so its order and
+        the indexes already handed out stay valid"""
+        self._next_size = size
+
+    def set_epoch(self, epoch):
+        "Jumps to the start of the given epoch"
+        self.epoch = epoch
+        self._position = 0
+        self._size = self._next_size
+
+    def _epoch_order(self, shuffle):
+        "Indexes of the current epoch that belong to this rank"
+        if self._order_key != (self.epoch, shuffle, self._size):
+            if shuffle and self._block_size > 1:
+                random_state = np.random.RandomState((self.seed + self.epoch) % 2**32)
+                block_count = -(-self._size // self._block_size)
+                starts = random_state.permutation(block_count) * self._block_size
+                order = (starts[:, np.newaxis] + np.arange(self._block_size)).ravel()
+                order = order[order < self._size]
+            elif shuffle:
+                random_state = np.random.RandomState((self.seed + self.epoch) % 2**32)
+                order = random_state.permutation(self._size)
+            else:
+                order = np.arange(self._size)
+            start = self._rank * len(self)
+            self._order = order[start:start+len(self)]
+            self._order_key = (self.epoch, shuffle, self._size)
+        return self._order
+
+    def next_indexes(self, count, shuffle):
+        """Returns the next count indexes, running into the next epochs if needed
+
+        Also returns how many epoch boundaries were crossed"""
+        assert len(self) > 0, "Not enough data for world_size {}".format(self._world_size)
+
+        indexes = []
+        epoch_ends = 0
+        while count > 0:
+            order = self._epoch_order(shuffle)
+            taken = order[self._position:self._position+count]
+            indexes.append(taken)
+            count -= len(taken)
+            self._position += len(taken)
+            if self._position == len(order):
+                self.set_epoch(self.epoch + 1)
+                epoch_ends += 1
+
+        if len(indexes) == 1:
+            return (indexes[0], epoch_ends)
+        return (np.concatenate(indexes), epoch_ends)
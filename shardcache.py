@@ -0,0 +1,185 @@
+"""Cache split into fixed size shards, for data sets larger than memory"""
+import json
+from os import makedirs, replace
+from os.path import isdir, join
+
+import numpy as np
+
+if __package__:
+    from .sampler import EpochSampler
+else:
+    from sampler import EpochSampler
+
+INDEX_FILE = "index.json"
+SHARD_EXT = ".npy"
+
+def _shard_path(cache_dir, name, shard):
+    return join(cache_dir, "{}.{:05d}{}".format(name, shard, SHARD_EXT))
+
+def save_array(path, array):
+    "Write a raw .npy file, replacing any previous one atomically"
+    # Readers may have the old file mapped, never truncate it in place
+    tmp_path = path+".tmp"
+    with open(tmp_path, "wb") as array_file:
+        np.save(array_file, np.asarray(array))
+    replace(tmp_path, path)
+
+class ShardWriter(object):
+    """Writes tiles into shards of shard_size tiles as they arrive
+
+    At most one shard worth of tiles is held in memory"""
+
+    def __init__(self, cache_dir, shard_size):
+        if not isdir(cache_dir):
+            makedirs(cache_dir)
+        self._cache_dir = cache_dir
+        self._shard_size = shard_size
+        self._img_data = []
+        self._label_data = []
+        self._buffered = 0
+        self._shards = []
+
+    def add(self, img_data, label_data):
+        "Queue tiles, full shards are written right away"
+        self._img_data.append(img_data)
+        self._label_data.append(label_data)
+        self._buffered += len(img_data)
+        while self._buffered >= self._shard_size:
+            self._flush(self._shard_size)
+
+    def _flush(self, count):
+        img_data = np.concatenate(self._img_data)
+        label_data = np.concatenate(self._label_data)
+        shard = len(self._shards)
+        save_array(_shard_path(self._cache_dir, "img_data", shard), img_data[:count])
+        save_array(_shard_path(self._cache_dir, "label_data", shard), label_data[:count])
+        self._shards.append(count)
+        self._img_data = [img_data[count:]]
+        self._label_data = [label_data[count:]]
+        self._buffered -= count
+
+    def close(self):
+        "Writes the last partial shard and the index"
+        if self._buffered > 0:
+            self._flush(self._buffered)
+        index_path = join(self._cache_dir, INDEX_FILE)
+        with open(index_path+".tmp", "w") as index_file:
+            json.dump({"shard_size": self._shard_size, "shards": self._shards}, index_file)
+        replace(index_path+".tmp", index_path)
+
+class ShardWindow(object):
+    """Streams the shards of a cache through a window of resident shards
+
+    Shards are visited in an EpochSampler order, so shard order is shuffled
+    per epoch and split across ranks. Up to resident_shards shards are loaded
+    at once and their remaining tiles are drawn from in a shuffled mix. A
+    shard is evicted, and the next one loaded, once all its tiles are used.
+    A shard drawn again while still resident, by the next epoch, has its
+    tiles queued once more instead of being loaded a second time."""
+
+    def __init__(self, cache_dir, resident_shards, seed=None, rank=0, world_size=1):
+        with open(join(cache_dir, INDEX_FILE), "r") as index_file:
+            index = json.load(index_file)
+        self._cache_dir = cache_dir
+        self._shard_tiles = index["shards"]
+
+        self.sampler = EpochSampler(len(self._shard_tiles), seed, rank, world_size)
+        self._random_state = np.random.RandomState(self.sampler.seed)
+        # Every slot holds a different shard
+        self._resident_shards = min(resident_shards, len(self.sampler))
+        # Epoch of the last shard drawn, epoch ends are counted as the
+        # first shard of the next epoch is drawn
+        self._drawn_epoch = self.sampler.epoch
+
+        self._img_slots = [None] * self._resident_shards
+        self._label_slots = [None] * self._resident_shards
+        self._slot_shards = [None] * self._resident_shards
+        self._slot_left = np.zeros(self._resident_shards, dtype=np.intp)
+        # Tiles not handed out yet, as (slot, row) pairs with their epoch
+        self._pending_slots = np.zeros(0, dtype=np.intp)
+        self._pending_rows = np.zeros(0, dtype=np.intp)
+        self._pending_epochs = np.zeros(0, dtype=np.intp)
+
+    def __len__(self):
+        return sum(self._shard_tiles)
+
+    def _draw_shard(self, shuffle):
+        "Next shard of the sampler, its epoch and the epoch boundaries crossed to reach it"
+        epoch = int(self.sampler.index_epochs(1)[0])
+        (shard,), _ = self.sampler.next_indexes(1, shuffle)
+        epoch_ends = max(epoch - self._drawn_epoch, 0)
+        self._drawn_epoch = epoch
+        return (shard, epoch, epoch_ends)
+
+    def _queue_tiles(self, slot, count, epoch, shuffle):
+        """Adds count tiles of slot, drawn for epoch, to the tiles not handed out yet
+
+        Tiles are shuffled with the others of their epoch only, every tile
+        of an epoch is handed out before any of the next"""
+        self._slot_left[slot] += count
+        self._pending_slots = np.concatenate([self._pending_slots,
+                                              np.full(count, slot, dtype=np.intp)])
+        self._pending_rows = np.concatenate([self._pending_rows,
+                                             np.arange(count, dtype=np.intp)])
+        self._pending_epochs = np.concatenate([self._pending_epochs,
+                                               np.full(count, epoch, dtype=np.intp)])
+        if shuffle:
+            start = np.searchsorted(self._pending_epochs, epoch)
+            order = start + self._random_state.permutation(len(self._pending_slots) - start)
+            self._pending_slots[start:] = self._pending_slots[order]
+            self._pending_rows[start:] = self._pending_rows[order]
+
+    def _load_slot(self, slot, shuffle):
+        "Loads the next shard into slot, returns the epoch boundaries crossed"
+        epoch_ends = 0
+        while True:
+            shard, epoch, shard_epoch_ends = self._draw_shard(shuffle)
+            epoch_ends += shard_epoch_ends
+            resident = [other for other in range(self._resident_shards)
+                        if self._slot_shards[other] == shard and self._slot_left[other] > 0]
+            if not resident:
+                break
+            self._queue_tiles(resident[0], self._shard_tiles[shard], epoch, shuffle)
+
+        if self._slot_shards[slot] != shard:
+            self._img_slots[slot] = np.load(_shard_path(self._cache_dir, "img_data", shard))
+            self._label_slots[slot] = np.load(_shard_path(self._cache_dir, "label_data", shard))
+            self._slot_shards[slot] = shard
+        self._queue_tiles(slot, len(self._img_slots[slot]), epoch, shuffle)
+        return epoch_ends
+
+    def get_batch(self, size, shuffle, img_out=None):
+        """Returns size images and compact labels
+
+        Also returns the epoch boundaries crossed while loading shards"""
+        epoch_ends = 0
+        for slot in range(self._resident_shards):
+            if self._img_slots[slot] is None:
+                epoch_ends += self._load_slot(slot, shuffle)
+
+        if img_out is None:
+            img_out = np.empty((size,) + self._img_slots[0].shape[1:], self._img_slots[0].dtype)
+        label_batch = np.empty((size,) + self._label_slots[0].shape[1:],
+                               self._label_slots[0].dtype)
+
+        filled = 0
+        while filled < size:
+            count = min(size - filled, len(self._pending_slots))
+            slots = self._pending_slots[:count]
+            rows = self._pending_rows[:count]
+            self._pending_slots = self._pending_slots[count:]
+            self._pending_rows = self._pending_rows[count:]
+            self._pending_epochs = self._pending_epochs[count:]
+
+            for slot in np.unique(slots):
+                in_slot = np.nonzero(slots == slot)[0]
+                img_out[filled+in_slot] = self._img_slots[slot][rows[in_slot]]
+                label_batch[filled+in_slot] = self._label_slots[slot][rows[in_slot]]
+                self._slot_left[slot] -= len(in_slot)
+            filled += count
+
+            # Every tile of these shards is handed out, swap in the next ones
+            for slot in np.nonzero(self._slot_left == 0)[0]:
+                epoch_ends += self._load_slot(slot, shuffle)
+
+        return (img_out, label_batch, epoch_ends)
@@ -0,0 +1,175 @@
+"""Worker processes loading batches into a ring of shared memory slots"""
+import multiprocessing
+from multiprocessing import shared_memory
+from queue import Empty
+
+import numpy as np
+
+if __package__:
+    from .sampler import EpochSampler
+else:
+    from sampler import EpochSampler
+
+# Seconds between checks for a stopped pool while blocked on a queue
+POLL_INTERVAL = 0.1
+# Seconds close() waits for a worker before terminating it
+JOIN_TIMEOUT = 5.0
+
+def _slot_array(memory, slots, batch_size, tile_shape, dtype):
+    "(slots, batch_size) + tile_shape array backed by memory"
+    return np.ndarray((slots, batch_size) + tile_shape, dtype=dtype, buffer=memory.buf)
+
+def _get_slot(free_slots, stop):
+    "Next free slot, None once the pool is stopped"
+    while not stop.is_set():
+        try:
+            return free_slots.get(timeout=POLL_INTERVAL)
+        except Empty:
+            continue
+    return None
+
+def _worker(load, settings, file_list, worker, workers, shuffle, sampler_args, epoch,
+            layout, free_slots, ready_slots, stop):
+    """Worker process, loads files and fills free slots with their tiles
+
+    Every worker follows the same EpochSampler order and takes one file out
+    of each workers files, so together they load every file of an epoch once"""
+    memories = []
+    try:
+        slot_arrays = []
+        for name, slots, batch_size, tile_shape, dtype in layout:
+            memory = shared_memory.SharedMemory(name=name)
+            memories.append(memory)
+            slot_arrays.append(_slot_array(memory, slots, batch_size, tile_shape, dtype))
+        img_slots, label_slots = slot_arrays
+        batch_size = img_slots.shape[1]
+
+        sampler = EpochSampler(len(file_list), *sampler_args)
+        sampler.set_epoch(epoch)
+
+        slot = None
+        filled = 0
+        while not stop.is_set():
+            indexes, _ = sampler.next_indexes(workers, shuffle)
+            img_data, label_data = load(settings, file_list[indexes[worker]])
+
+            start = 0
+            while start < len(img_data):
+                if slot is None:
+                    slot = _get_slot(free_slots, stop)
+                    if slot is None:
+                        return
+                    filled = 0
+                # Tiles are written once, straight into the shared batch
+                count = min(batch_size - filled, len(img_data) - start)
+                img_slots[slot, filled:filled+count] = img_data[start:start+count]
+                label_slots[slot, filled:filled+count] = label_data[start:start+count]
+                filled += count
+                start += count
+                if filled == batch_size:
+                    ready_slots.put(slot)
+                    slot = None
+    except Exception as error: # pylint: disable=W0703
+        # Handed to the consumer, which re-raises it from get
+        ready_slots.put(error)
+    finally:
+        img_slots = label_slots = slot_arrays = None
+        for memory in memories:
+            memory.close()
+
+class SharedBatchPool(object):
+    """Worker processes decoding, tiling and encoding into shared batch slots
+
+    The slots are batch_size sized image and compact label arrays in
+    multiprocessing.shared_memory, so tiles are never pickled. Workers take
+    a free slot, fill it and pass its number to the consumer. get() returns
+    views of the slot, which goes back to the workers on release() or on
+    the next get()."""
+
+    def __init__(self, load, settings, file_list, batch_size, slots, workers, shuffle,
+                 seed, rank=0, world_size=1, epoch=0, block_size=1):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+        # Tile shapes and dtypes are only known after preprocessing and
+        # encoding, take them from the first file that has tiles
+        sample = None
+        for file_name in file_list:
+            sample = load(settings, file_name)
+            if len(sample[0]) > 0:
+                break
+        assert sample is not None and len(sample[0]) > 0, "No file has any labelled tile"
+
+        self._memories = []
+        layout = []
+        slot_arrays = []
+        for tiles in sample:
+            tile_shape = tiles.shape[1:]
+            size = slots * batch_size * int(np.prod(tile_shape)) * tiles.dtype.itemsize
+            memory = shared_memory.SharedMemory(create=True, size=size)
+            self._memories.append(memory)
+            layout.append((memory.name, slots, batch_size, tile_shape, tiles.dtype))
+            slot_arrays.append(_slot_array(memory, slots, batch_size, tile_shape, tiles.dtype))
+        self._img_slots, self._label_slots = slot_arrays
+
+        self._free_slots = multiprocessing.Queue()
+        self._ready_slots = multiprocessing.Queue()
+        for slot in range(slots):
+            self._free_slots.put(slot)
+        self._held = None
+        self._stop = multiprocessing.Event()
+
+        self._workers = []
+        for worker in range(workers):
+            process = multiprocessing.Process(
+                target=_worker,
+                args=(load, settings, file_list, worker, workers, shuffle,
+                      (seed, rank, world_size, block_size), epoch, layout,
+                      self._free_slots, self._ready_slots, self._stop))
+            process.daemon = True
+            process.start()
+            self._workers.append(process)
+
+    def get(self):
+        """Returns the (images, compact labels) of the next full slot
+
+        They are views of shared memory, valid until release() or get()"""
+        self.release()
+        while True:
+            try:
+                slot = self._ready_slots.get(timeout=POLL_INTERVAL)
+            except Empty:
+                if not any(process.is_alive() for process in self._workers):
+                    raise RuntimeError("SharedBatchPool workers exited")
+                continue
+            if isinstance(slot, Exception):
+                raise slot
+            self._held = slot
+            return (self._img_slots[slot], self._label_slots[slot])
+
+    def release(self):
+        "Hands the slot of the last get() back to the workers"
+        if self._held is not None:
+            self._free_slots.put(self._held)
+            self._held = None
+
+    def close(self):
+        "Stops the workers and frees the shared memory"
+        self._stop.set()
+        for process in self._workers:
+            process.join(JOIN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self._workers = []
+        self._held = None
+
+        self._img_slots = self._label_slots = None
+        for memory in self._memories:
+            try:
+                memory.close()
+            except BufferError:
+                # Batch views are still referenced, the mapping goes with them
+                pass
+            memory.unlink()
+        self._memories = []
@@ -0,0 +1,56 @@
+"""The modules are imported from the repository root, as scripts do"""
+import os
+import sys
+import time
+from os.path import abspath, dirname, join
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+FRAME_COUNT = 6
+
+def _write_frame(data_path, file_name, labelled=True, seed=0):
+    """Writes a 96x128 image, label pair, the label has one red box unless
+    labelled is False"""
+    random_state = np.random.RandomState(seed)
+    image = random_state.randint(0, 256, (96, 128, 3)).astype(np.uint8)
+    label = np.zeros((96, 128, 4), np.uint8)
+    if labelled:
+        top, left = random_state.randint(0, 60), random_state.randint(0, 90)
+        # F44336, the first class of ObjClass, opaque for ObjClass2
+        label[top:top+30, left:left+30] = (0x36, 0x43, 0xF4, 255)
+    cv2.imwrite(join(data_path, "raw_img", file_name), image)
+    cv2.imwrite(join(data_path, "label", file_name), label)
+
+def _settle(data_path):
+    "Backdates the data set, so its folder listings are trusted"
+    past = time.time() - 60
+    for folder in ("raw_img", "label"):
+        folder_path = join(data_path, folder)
+        for file_name in os.listdir(folder_path):
+            os.utime(join(folder_path, file_name), (past, past))
+        os.utime(folder_path, (past, past))
+
+@pytest.fixture
+def write_frame():
+    "Writes one image, label pair into a data set, see _write_frame"
+    return _write_frame
+
+@pytest.fixture
+def settle():
+    "Backdates a data set, see _settle"
+    return _settle
+
+@pytest.fixture
+def data_set(tmp_path):
+    "A settled data set of FRAME_COUNT labelled frames, f000.png on"
+    data_path = str(tmp_path)
+    os.makedirs(join(data_path, "raw_img"))
+    os.makedirs(join(data_path, "label"))
+    for index in range(FRAME_COUNT):
+        _write_frame(data_path, "f{:03d}.png".format(index), seed=index)
+    _settle(data_path)
+    return data_path
@@ -0,0 +1,99 @@
+"""DataFeeder caches and label index against changes to the data set"""
+import os
+import shutil
+from os.path import join
+
+import numpy as np
+import pytest
+
+from GeneralDataFeeder import DataFeeder
+
+SETTINGS = dict(data_padding=8, label_width=32, seed=1)
+
+def _epoch_tiles(data_path, **kwargs):
+    "Tiles of one dynamic_load epoch, and the counters of the DataFeeder"
+    with DataFeeder(data_path, dynamic_load=True, stats=True, **dict(SETTINGS, **kwargs)) as feeder:
+        tiles = sum(len(img_batch) for img_batch, _ in feeder.iter_batches(4))
+        return tiles, feeder.stats()["counters"]
+
+def test_label_rewritten_in_place_makes_cache_stale(data_set, write_frame):
+    DataFeeder(data_set, missing_cache="build", **SETTINGS)
+    DataFeeder(data_set, missing_cache="fail", **SETTINGS)
+    # The label folder keeps its mtime
+    write_frame(data_set, "f003.png", labelled=False, seed=3)
+    with pytest.raises(RuntimeError):
+        DataFeeder(data_set, missing_cache="fail", **SETTINGS)
+
+def test_label_filled_in_place_is_read_again(data_set, write_frame):
+    labelled_tiles, counters = _epoch_tiles(data_set)
+    skipped = counters.get("files_skipped", 0)
+    write_frame(data_set, "f003.png", labelled=False, seed=3)
+    blank_tiles, _ = _epoch_tiles(data_set)
+    assert blank_tiles < labelled_tiles
+    _, counters = _epoch_tiles(data_set)
+    assert counters["files_skipped"] > skipped
+
+    write_frame(data_set, "f003.png", seed=3)
+    tiles, counters = _epoch_tiles(data_set)
+    assert tiles == labelled_tiles
+    assert counters.get("files_skipped", 0) == skipped
+
+def _cache_arrays(data_path, **kwargs):
+    feeder = DataFeeder(data_path, missing_cache="fail", **dict(SETTINGS, **kwargs))
+    return np.array(feeder._img_data), np.array(feeder._label_data)
+
+def test_rebuild_decodes_only_changed_files(data_set, write_frame, settle):
+    DataFeeder(data_set, missing_cache="build", **SETTINGS)
+    write_frame(data_set, "f002.png", seed=20)
+    write_frame(data_set, "f100.png", seed=100)
+    settle(data_set)
+    with pytest.raises(RuntimeError):
+        DataFeeder(data_set, missing_cache="fail", **SETTINGS)
+
+    decoded = []
+    feeder = DataFeeder(data_set, missing_cache="build", **SETTINGS)
+    feeder.build_cache(progress=lambda entry, was_decoded: was_decoded and decoded.append(
+        entry["name"]))
+    assert decoded == []
+
+    write_frame(data_set, "f004.png", seed=40)
+    feeder.build_cache(progress=lambda entry, was_decoded: was_decoded and decoded.append(
+        entry["name"]))
+    assert decoded == ["f004.png"]
+
+    img_data, label_data = _cache_arrays(data_set)
+    DataFeeder(data_set, cache_name="full", missing_cache="build", **SETTINGS)
+    full_img_data, full_label_data = _cache_arrays(data_set, cache_name="full")
+    assert np.array_equal(img_data, full_img_data)
+    assert np.array_equal(label_data, full_label_data)
+
+def test_cache_formats_keep_their_own_manifest(data_set, write_frame):
+    DataFeeder(data_set, cache_format="mmap", missing_cache="build", **SETTINGS)
+    mmap_tiles = len(_cache_arrays(data_set, cache_format="mmap")[0])
+    write_frame(data_set, "f100.png", seed=100)
+    DataFeeder(data_set, cache_format="npz", missing_cache="build", **SETTINGS)
+    assert len(_cache_arrays(data_set)[0]) > mmap_tiles
+    with pytest.raises(RuntimeError):
+        DataFeeder(data_set, cache_format="mmap", missing_cache="fail", **SETTINGS)
+
+def test_cache_loads_without_its_data_set(data_set):
+    DataFeeder(data_set, missing_cache="build", **SETTINGS)
+    img_data, label_data = _cache_arrays(data_set)
+    shutil.rmtree(join(data_set, "raw_img"))
+    shutil.rmtree(join(data_set, "label"))
+    feeder = DataFeeder(data_set, missing_cache="fail", **SETTINGS)
+    assert np.array_equal(feeder._img_data, img_data)
+    assert np.array_equal(feeder._label_data, label_data)
+
+def test_dynamic_load_starts_with_unlabelled_images(data_set, write_frame):
+    labelled_tiles, _ = _epoch_tiles(data_set)
+    write_frame(data_set, "f100.png", seed=100)
+    os.rename(join(data_set, "label", "f100.png"), join(data_set, "f100.png"))
+    with DataFeeder(data_set, dynamic_load=True, **SETTINGS) as feeder:
+        assert sum(len(img_batch) for img_batch, _ in feeder.iter_batches(4)) == labelled_tiles
+        assert feeder.refresh_files() == []
+        os.rename(join(data_set, "f100.png"), join(data_set, "label", "f100.png"))
+        assert feeder.refresh_files() == ["f100.png"]
+        # Sampled from the next epoch not loaded yet
+        tiles = sum(len(img_batch) for img_batch, _ in feeder.iter_batches(4, epochs=2))
+        assert tiles > 2 * labelled_tiles
@@ -0,0 +1,58 @@
+"""DataSetListing relists a folder only when it changed, file states are always read"""
+import os
+from os.path import join
+
+import filescan
+from filescan import DataSetListing
+
+FOLDERS = ("raw_img", "label")
+
+def _count_listings(monkeypatch):
+    listed = []
+    file_names = filescan.file_names
+    def counting_file_names(path):
+        listed.append(path)
+        return file_names(path)
+    monkeypatch.setattr(filescan, "file_names", counting_file_names)
+    return listed
+
+def test_scan_lists_sorted_names(data_set):
+    img_list, label_list = DataSetListing(data_set, FOLDERS).scan()
+    assert img_list == label_list == ["f{:03d}.png".format(index) for index in range(6)]
+
+def test_unchanged_folders_are_not_listed_again(data_set, monkeypatch):
+    DataSetListing(data_set, FOLDERS).scan()
+    listed = _count_listings(monkeypatch)
+    listing = DataSetListing(data_set, FOLDERS)
+    listing.scan()
+    listing.scan()
+    assert listed == []
+
+def test_changed_folder_is_listed_again(data_set, write_frame, settle, monkeypatch):
+    listing = DataSetListing(data_set, FOLDERS)
+    listing.scan()
+    write_frame(data_set, "f100.png")
+    settle(data_set)
+    img_list, label_list = listing.scan()
+    assert "f100.png" in img_list and "f100.png" in label_list
+
+    os.remove(join(data_set, "label", "f000.png"))
+    listed = _count_listings(monkeypatch)
+    img_list, label_list = listing.scan()
+    assert listed == [join(data_set, "label")]
+    assert "f000.png" in img_list and "f000.png" not in label_list
+
+def test_file_states_see_in_place_rewrites(data_set, write_frame):
+    listing = DataSetListing(data_set, FOLDERS)
+    listing.scan()
+    before = listing.file_states("label")
+    write_frame(data_set, "f003.png", labelled=False, seed=3)
+    after = listing.file_states("label")
+    assert listing.scan()[1] == sorted(before)
+    assert after["f003.png"] != before["f003.png"]
+    assert after["f002.png"] == before["f002.png"]
+
+def test_unreadable_manifest_is_rebuilt(data_set):
+    with open(join(data_set, filescan.FILE_MANIFEST), "w") as manifest_file:
+        manifest_file.write("{\"raw_img\": ")
+    assert DataSetListing(data_set, FOLDERS).scan()[0][0] == "f000.png"
@@ -0,0 +1,71 @@
+"""Label index entries are dropped once their label file or the settings change"""
+import os
+from os.path import join
+
+import labelindex
+from labelindex import LabelIndex, label_state, make_entry, read_index, valid_entries
+
+SETTINGS = {"data_padding": 8, "label_height": 32, "label_width": 32,
+            "target_size": None, "min_label_pixels": 1}
+
+def _entries(data_set, names):
+    "Entries of names, f001.png without any kept tile"
+    return {name: make_entry(join(data_set, "label", name), (96, 128, 4),
+                             [] if name == "f001.png" else [[0, 1]])
+            for name in names}
+
+def _label_states(data_set, names):
+    return {name: label_state(join(data_set, "label", name)) for name in names}
+
+def test_index_is_tied_to_settings(data_set):
+    path = join(data_set, labelindex.LABEL_INDEX_FILE)
+    entries = _entries(data_set, ["f000.png", "f001.png"])
+    labelindex.write_index(path, SETTINGS, entries)
+    assert read_index(path, SETTINGS) == entries
+    assert read_index(path, dict(SETTINGS, label_width=16)) == {}
+    assert read_index(join(data_set, "missing.json"), SETTINGS) == {}
+
+def test_changed_labels_are_dropped(data_set, write_frame):
+    names = ["f000.png", "f001.png", "f002.png"]
+    entries = _entries(data_set, names)
+    write_frame(data_set, "f001.png", labelled=True, seed=10)
+    valid = valid_entries(entries, _label_states(data_set, names + ["f003.png"]))
+    assert sorted(valid) == ["f000.png", "f002.png"]
+    assert sorted(valid_entries(entries, _label_states(data_set, ["f002.png"]))) == ["f002.png"]
+
+def test_label_index_saves_every_interval(data_set, monkeypatch):
+    path = join(data_set, labelindex.LABEL_INDEX_FILE)
+    writes = []
+    write_index = labelindex.write_index
+    def counting_write_index(*args):
+        writes.append(len(args[2]))
+        write_index(*args)
+    monkeypatch.setattr(labelindex, "write_index", counting_write_index)
+
+    index = LabelIndex(path, SETTINGS, save_interval=2)
+    entries = _entries(data_set, ["f000.png", "f001.png", "f002.png"])
+    for name in sorted(entries):
+        index.record(name, entries[name])
+    assert writes == [2]
+    index.save()
+    index.save()
+    assert writes == [2, 3]
+    assert index.empty_files() == frozenset(["f001.png"])
+
+    reloaded = LabelIndex(path, SETTINGS, save_interval=2)
+    reloaded.load(_label_states(data_set, sorted(entries)))
+    assert reloaded.get("f002.png") == entries["f002.png"]
+    assert reloaded.empty_files() == frozenset(["f001.png"])
+
+def test_failed_write_leaves_no_temporary_file(data_set, monkeypatch):
+    def failing_replace(*args):
+        raise OSError(30, "Read-only file system")
+    monkeypatch.setattr(labelindex, "replace", failing_replace)
+    labelindex.write_index(join(data_set, labelindex.LABEL_INDEX_FILE), SETTINGS, {})
+    assert not [name for name in os.listdir(data_set) if name.endswith(".tmp")]
+    assert not os.path.exists(join(data_set, labelindex.LABEL_INDEX_FILE))
+
+def test_index_is_readable_by_other_users(data_set):
+    path = join(data_set, labelindex.LABEL_INDEX_FILE)
+    labelindex.write_index(path, SETTINGS, {})
+    assert os.stat(path).st_mode & 0o044 == 0o044
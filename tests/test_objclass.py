@@ -0,0 +1,52 @@
+"""Label codec of ObjClass checked against the per class cv2.inRange loop"""
+from os.path import abspath, dirname, join
+
+import cv2
+import numpy as np
+
+import ObjClass
+
+CANVAS_PATH = join(dirname(dirname(abspath(__file__))), "canvas.png")
+
+def _canvas():
+    canvas = cv2.imread(CANVAS_PATH, cv2.IMREAD_UNCHANGED)
+    assert canvas is not None, "canvas.png is missing"
+    return canvas
+
+def _in_range_label(raw_label):
+    "process_label as it was first written, one cv2.inRange per class"
+    range_img = []
+    for obj_class in ObjClass.CLASS:
+        mask = cv2.inRange(raw_label, obj_class.get_bgra(0), obj_class.get_bgra(255))
+        mask = mask.astype(np.float32)/255.
+        range_img.append(np.reshape(mask, mask.shape+(1,)))
+    return np.concatenate(range_img, axis=2)
+
+def test_process_label_matches_in_range():
+    canvas = _canvas()
+    assert np.array_equal(ObjClass.process_label(canvas), _in_range_label(canvas))
+
+def test_encode_label_indexes():
+    canvas = _canvas()
+    label_index = ObjClass.encode_label(canvas)
+    assert label_index.dtype == np.uint8
+    assert label_index.shape == canvas.shape[:2]
+
+    reference = _in_range_label(canvas)
+    matched = reference.max(axis=2) > 0
+    assert matched.any() and not matched.all()
+    assert np.array_equal(label_index[matched], reference.argmax(axis=2)[matched])
+    assert np.all(label_index[~matched] == ObjClass.NO_CLASS)
+
+def test_encode_label_batch():
+    canvas = _canvas()
+    batch = np.stack([canvas, canvas[::-1]])
+    label_index = ObjClass.encode_label(batch)
+    assert np.array_equal(label_index[0], ObjClass.encode_label(canvas))
+    assert np.array_equal(label_index[1], ObjClass.encode_label(canvas[::-1]))
+
+def test_compact_label_round_trip():
+    canvas = _canvas()
+    compact = ObjClass.compact_label(canvas)
+    sparse = ObjClass.sparse_label(compact, canvas.shape[1])
+    assert np.array_equal(ObjClass.expand_label(sparse), ObjClass.process_label(canvas))
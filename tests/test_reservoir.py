@@ -0,0 +1,61 @@
+"""TileReservoir put and take ordering"""
+import numpy as np
+
+from reservoir import TileReservoir
+
+def _put(reservoir, ids, epoch=0):
+    ids = np.asarray(ids)
+    img_data = np.repeat(ids[:, np.newaxis], 4, axis=1).astype(np.float32)
+    reservoir.put(img_data, ids.astype(np.uint8), np.full(len(ids), epoch))
+
+def _ids(taken):
+    assert np.array_equal(taken[0][:, 0].astype(np.uint8), taken[1])
+    return list(taken[1])
+
+def test_oldest_first_across_wrap_around():
+    reservoir = TileReservoir(5)
+    _put(reservoir, [0, 1, 2, 3])
+    assert _ids(reservoir.take(3)) == [0, 1, 2]
+    _put(reservoir, [4, 5, 6, 7])
+    assert reservoir.capacity == 5
+    assert _ids(reservoir.take(2)) == [3, 4]
+    _put(reservoir, [8, 9])
+    assert _ids(reservoir.take(10)) == [5, 6, 7, 8, 9]
+    assert len(reservoir) == 0
+    assert reservoir.take(1) is None
+
+def test_max_epoch_keeps_later_tiles_in_order():
+    reservoir = TileReservoir(8)
+    _put(reservoir, [0, 1], epoch=0)
+    _put(reservoir, [2, 3], epoch=1)
+    _put(reservoir, [4, 5], epoch=0)
+    assert list(reservoir.take(8, max_epoch=0)[2]) == [0, 0, 0, 0]
+    assert reservoir.take(1, max_epoch=0) is None
+    _put(reservoir, [6], epoch=1)
+    assert _ids(reservoir.take(8)) == [2, 3, 6]
+
+def test_random_take_keeps_every_tile_once():
+    reservoir = TileReservoir(6)
+    random_state = np.random.RandomState(3)
+    taken = []
+    for start in range(0, 24, 4):
+        _put(reservoir, range(start, start+4))
+        taken += _ids(reservoir.take(3, random_state))
+    taken += _ids(reservoir.take(24, random_state))
+    assert sorted(taken) == list(range(24))
+
+def test_grow_keeps_order():
+    reservoir = TileReservoir(4)
+    _put(reservoir, [0, 1, 2])
+    reservoir.take(2)
+    _put(reservoir, [3, 4, 5])
+    reservoir.grow()
+    assert reservoir.capacity == 8
+    _put(reservoir, [6, 7, 8, 9])
+    assert _ids(reservoir.take(8)) == [2, 3, 4, 5, 6, 7, 8, 9]
+
+def test_put_without_stop_grows():
+    reservoir = TileReservoir(2)
+    _put(reservoir, [0, 1, 2])
+    assert reservoir.capacity >= 3
+    assert _ids(reservoir.take(3)) == [0, 1, 2]
@@ -0,0 +1,51 @@
+"""EpochSampler hands out each index once per epoch, split by rank"""
+import numpy as np
+import pytest
+
+from sampler import EpochSampler
+
+def _epoch(sampler, shuffle):
+    indexes, epoch_ends = sampler.next_indexes(len(sampler), shuffle)
+    assert epoch_ends == 1
+    return indexes
+
+@pytest.mark.parametrize("shuffle", [False, True])
+@pytest.mark.parametrize("block_size", [1, 3])
+def test_each_index_once_per_epoch(shuffle, block_size):
+    sampler = EpochSampler(10, seed=5, block_size=block_size)
+    for _ in range(3):
+        assert sorted(_epoch(sampler, shuffle)) == list(range(10))
+
+def test_uneven_draws_cover_each_epoch():
+    sampler = EpochSampler(10, seed=5)
+    epochs = sampler.index_epochs(30)
+    indexes = np.concatenate([sampler.next_indexes(count, True)[0] for count in (4, 7, 9, 10)])
+    for epoch in range(3):
+        assert sorted(indexes[epochs == epoch]) == list(range(10))
+
+@pytest.mark.parametrize("block_size", [1, 3])
+def test_ranks_are_disjoint(block_size):
+    size, world_size = 11, 3
+    for _ in range(2):
+        shares = [EpochSampler(size, seed=7, rank=rank, world_size=world_size,
+                               block_size=block_size)
+                  for rank in range(world_size)]
+        for epoch in range(2):
+            drawn = []
+            for sampler in shares:
+                sampler.set_epoch(epoch)
+                drawn.append(_epoch(sampler, True))
+            merged = np.concatenate(drawn)
+            assert len(merged) == size // world_size * world_size
+            assert len(np.unique(merged)) == len(merged)
+            assert merged.min() >= 0 and merged.max() < size
+
+def test_resize_applies_next_epoch():
+    sampler = EpochSampler(6, seed=1)
+    first, _ = sampler.next_indexes(2, True)
+    sampler.resize(9)
+    assert list(sampler.index_epochs(6)) == [0]*4 + [1]*2
+    rest, epoch_ends = sampler.next_indexes(sampler.remaining(), True)
+    assert epoch_ends == 1
+    assert sorted(np.concatenate([first, rest])) == list(range(6))
+    assert sorted(_epoch(sampler, True)) == list(range(9))
@@ -0,0 +1,49 @@
+"""ShardWindow hands out every tile of a sharded cache once per epoch"""
+import numpy as np
+import pytest
+
+from shardcache import ShardWindow, ShardWriter
+
+TILE_COUNT = 23
+
+def _write_shards(cache_dir, tile_count=TILE_COUNT, shard_size=5):
+    "Tiles whose pixels hold their index, written in blocks of uneven size"
+    tiles = np.arange(tile_count)
+    writer = ShardWriter(cache_dir, shard_size)
+    for block in np.split(tiles, [3, 4, 11, 19]):
+        writer.add(np.repeat(block, 4).reshape(-1, 2, 2).astype(np.int32),
+                   block.astype(np.uint8))
+    writer.close()
+
+def _draw(window, count, batch_size=7, shuffle=True):
+    tiles = []
+    while len(tiles) < count:
+        img_batch, label_batch, _ = window.get_batch(batch_size, shuffle)
+        assert np.array_equal(img_batch[:, 0, 0], label_batch)
+        tiles.extend(label_batch.tolist())
+    return tiles[:count]
+
+@pytest.mark.parametrize("resident_shards", [1, 2, 4, 10])
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_every_tile_once_per_epoch(tmp_path, resident_shards, shuffle):
+    _write_shards(str(tmp_path))
+    window = ShardWindow(str(tmp_path), resident_shards, seed=3)
+    assert len(window) == TILE_COUNT
+    tiles = _draw(window, 4 * TILE_COUNT, shuffle=shuffle)
+    for epoch in range(4):
+        assert sorted(tiles[epoch*TILE_COUNT:(epoch+1)*TILE_COUNT]) == list(range(TILE_COUNT))
+
+def test_single_slot_keeps_cache_order(tmp_path):
+    _write_shards(str(tmp_path))
+    window = ShardWindow(str(tmp_path), 1, seed=3)
+    assert _draw(window, 2 * TILE_COUNT, shuffle=False) == 2 * list(range(TILE_COUNT))
+
+def test_ranks_read_disjoint_shards(tmp_path):
+    # Four shards of five tiles, two per rank and epoch
+    _write_shards(str(tmp_path), tile_count=20)
+    windows = [ShardWindow(str(tmp_path), 2, seed=5, rank=rank, world_size=2)
+               for rank in range(2)]
+    for epoch in range(3):
+        drawn = [set(_draw(window, 10, batch_size=5)) for window in windows]
+        assert len(drawn[0]) == len(drawn[1]) == 10
+        assert not drawn[0] & drawn[1]
@@ -0,0 +1,71 @@
+"""SharedBatchPool workers fill shared batches in sampler order"""
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from sampler import EpochSampler
+from shmpool import SharedBatchPool
+
+FILE_COUNT = 8
+
+def _load(settings, file_name):
+    "(file_name % 3) + 1 tiles of one file, pixels and labels hold the file name"
+    if file_name == settings:
+        raise ValueError("bad file {}".format(file_name))
+    count = file_name % 3 + 1
+    return (np.full((count, 2, 2, 3), file_name, np.float32),
+            np.full((count, 2), file_name, np.uint8))
+
+def _tiles(pool, batches):
+    tiles = []
+    for _ in range(batches):
+        img_batch, label_batch = pool.get()
+        assert np.array_equal(img_batch[:, 0, 0, 0], label_batch[:, 0])
+        tiles.extend(label_batch[:, 0].tolist())
+    return tiles
+
+def _expected(shuffle, epochs):
+    sampler = EpochSampler(FILE_COUNT, seed=2)
+    files, _ = sampler.next_indexes(epochs * FILE_COUNT, shuffle)
+    return [file_name for file_name in files for _ in range(file_name % 3 + 1)]
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_one_worker_follows_the_sampler(shuffle):
+    pool = SharedBatchPool(_load, None, list(range(FILE_COUNT)), 4, 3, 1, shuffle, seed=2)
+    try:
+        expected = _expected(shuffle, 3)
+        assert _tiles(pool, len(expected) // 4) == expected[:len(expected) // 4 * 4]
+    finally:
+        pool.close()
+
+def test_workers_share_the_files():
+    pool = SharedBatchPool(_load, None, list(range(FILE_COUNT)), 4, 3, 2, True, seed=2)
+    try:
+        tiles = _tiles(pool, 20)
+    finally:
+        pool.close()
+    assert set(tiles) == set(range(FILE_COUNT))
+    counts = np.bincount(tiles, minlength=FILE_COUNT)
+    # Every file is loaded whole, apart from the last one of each worker
+    assert sum(count % (file_name % 3 + 1) != 0
+               for file_name, count in enumerate(counts)) <= 2
+
+def test_worker_errors_reach_get():
+    pool = SharedBatchPool(_load, 5, list(range(FILE_COUNT)), 4, 3, 1, False, seed=2)
+    try:
+        with pytest.raises(ValueError):
+            _tiles(pool, 20)
+    finally:
+        pool.close()
+
+def test_close_frees_shared_memory():
+    pool = SharedBatchPool(_load, None, list(range(FILE_COUNT)), 4, 3, 2, False, seed=2)
+    names = [memory.name for memory in pool._memories]
+    # Batch views may outlive the pool
+    img_batch, _ = pool.get()
+    pool.close()
+    assert img_batch.shape == (4, 2, 2, 3)
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
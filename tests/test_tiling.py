@@ -0,0 +1,58 @@
+"""breakdown_n_filter against the per tile loop it replaced"""
+import numpy as np
+import pytest
+
+from tiling import breakdown_n_filter, kept_tiles
+
+def _loop_breakdown(img_data, label_data, padding, label_height, label_width, min_label_pixels):
+    "Tiles cut one by one in row major order, as the first breakdown_n_filter did"
+    height, width = img_data.shape[1:3]
+    img_tiles, label_tiles, frames = [], [], []
+    for index, (image, label) in enumerate(zip(img_data, label_data)):
+        for start_y in range(padding, height-label_height-padding+1, label_height):
+            for start_x in range(padding, width-label_width-padding+1, label_width):
+                label_tile = label[start_y:start_y+label_height, start_x:start_x+label_width]
+                labelled = label_tile != 0
+                if labelled.ndim > 2:
+                    labelled = labelled.any(axis=2)
+                if labelled.sum() < min_label_pixels:
+                    continue
+                img_tiles.append(image[start_y-padding:start_y+label_height+padding,
+                                       start_x-padding:start_x+label_width+padding])
+                label_tiles.append(label_tile)
+                frames.append(index)
+    return np.array(img_tiles), np.array(label_tiles), np.array(frames)
+
+def _frames(shape, channels, seed):
+    random_state = np.random.RandomState(seed)
+    img_data = random_state.randint(0, 256, shape + (3,)).astype(np.uint8)
+    label_data = np.zeros(shape + channels, np.float32)
+    # Sparse labels, so some tiles are dropped and some kept
+    mask = random_state.random_sample(shape) < 0.01
+    label_data[mask] = 1
+    return img_data, label_data
+
+@pytest.mark.parametrize("padding", [0, 8])
+@pytest.mark.parametrize("label_size", [(16, 16), (16, 24)])
+@pytest.mark.parametrize("channels", [(), (2,)])
+@pytest.mark.parametrize("min_label_pixels", [1, 3])
+def test_matches_loop(padding, label_size, channels, min_label_pixels):
+    # Frames that do not divide evenly into tiles
+    img_data, label_data = _frames((3, 70, 90), channels, seed=len(channels))
+    label_height, label_width = label_size
+    expected = _loop_breakdown(img_data, label_data, padding, label_height, label_width,
+                               min_label_pixels)
+    assert 0 < len(expected[0]) < 3 * 4 * 5
+
+    result = breakdown_n_filter(img_data, label_data, padding, label_height, label_width,
+                                return_frames=True, min_label_pixels=min_label_pixels)
+    for array, expected_array in zip(result, expected):
+        assert np.array_equal(array, expected_array)
+
+def test_kept_tiles_match_breakdown():
+    img_data, label_data = _frames((1, 70, 90), (2,), seed=4)
+    bimg_data = breakdown_n_filter(img_data, label_data, 8, 16, 16)[0]
+    tiles = kept_tiles(label_data[0], 8, 16, 16)
+    assert len(tiles) == len(bimg_data)
+    for (tile_y, tile_x), img_tile in zip(tiles, bimg_data):
+        assert np.array_equal(img_tile, img_data[0, tile_y*16:tile_y*16+32, tile_x*16:tile_x*16+32])
@@ -0,0 +1,216 @@
+"""Decoding, tiling and filtering of the frames of a data set
+
+Module level so the cache build and the worker_processes can run them in
+other processes"""
+import io
+from importlib import import_module
+from os.path import join
+
+import cv2
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+try:
+    from os import POSIX_FADV_WILLNEED, posix_fadvise
+except ImportError:
+    # Not on every platform, read_ahead does nothing there
+    posix_fadvise = None
+
+if __package__:
+    from . import cachemanifest
+    from . import imagesize
+else:
+    import cachemanifest
+    import imagesize
+
+IMAGE_FOLDER = "raw_img/"
+LABEL_FOLDER = "label/"
+
+# Decode modes shrinking the image by a factor while decoding, largest first
+REDUCED_COLOR_MODES = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                       (4, cv2.IMREAD_REDUCED_COLOR_4),
+                       (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+def breakdown_n_filter(img_data, label_data, data_padding, label_height, label_width,
+                       return_frames=False, min_label_pixels=1):
+    """Split images into padded tiles and drop tiles with an empty label
+
+    A tile is kept when at least min_label_pixels of its label pixels are
+    labelled, i.e. have any non-zero channel. With return_frames the index
+    of the image each tile was cut from is returned as well"""
+    # print(img_data.shape, label_data.shape)
+    assert img_data.shape[0] == label_data.shape[0], "img_data, label_data count do not match"
+    assert img_data.shape[1] == label_data.shape[1], "img_data, label_data height do not match"
+    assert img_data.shape[2] == label_data.shape[2], "img_data, label_data width do not match"
+    height = img_data.shape[1]
+    width = img_data.shape[2]
+    padding_y = data_padding
+    padding_x = data_padding
+
+    split_label_height = label_height
+    split_label_width = label_width
+
+    count_y, count_x = tile_grid(height, width, data_padding, label_height, label_width)
+
+    # (N, tiles_y, tiles_x, tile_height, tile_width, C) views, nothing is copied yet
+    bimg_view = _tile_view(img_data, count_y, count_x,
+                           split_label_height, split_label_width,
+                           split_label_height+2*padding_y, split_label_width+2*padding_x)
+    blabel_view = _tile_view(label_data[:, padding_y:, padding_x:], count_y, count_x,
+                             split_label_height, split_label_width,
+                             split_label_height, split_label_width)
+
+    keep = label_tile_counts(label_data, data_padding, label_height, label_width,
+                             count_y, count_x) >= min_label_pixels
+    keep_index = np.nonzero(keep)
+
+    # Fancy indexing copies the kept tiles, in row major order, exactly once
+    bimg_data = bimg_view[keep_index]
+    blabel_data = blabel_view[keep_index]
+
+    if return_frames:
+        return (bimg_data, blabel_data, keep_index[0])
+    return (bimg_data, blabel_data)
+
+def label_tile_counts(label_data, data_padding, label_height, label_width, count_y, count_x):
+    """Labelled pixels of every (N, tiles_y, tiles_x) label tile
+
+    Label tiles do not overlap, so the counts are a block sum over a mask of
+    the labelled pixels, computed once per image before any tile is copied"""
+    label_data = label_data[:, data_padding:data_padding+count_y*label_height,
+                            data_padding:data_padding+count_x*label_width]
+    if label_data.ndim > 3:
+        labelled = label_data.any(axis=tuple(range(3, label_data.ndim)))
+    else:
+        labelled = label_data != 0
+    blocks = labelled.reshape(len(labelled), count_y, label_height, count_x, label_width)
+    return blocks.sum(axis=(2, 4))
+
+def kept_tiles(label_data, data_padding, label_height, label_width, min_label_pixels=1):
+    "(y, x) grid positions of the tiles breakdown_n_filter keeps of one label image"
+    count_y, count_x = tile_grid(label_data.shape[0], label_data.shape[1], data_padding,
+                                 label_height, label_width)
+    counts = label_tile_counts(label_data[np.newaxis], data_padding, label_height, label_width,
+                               count_y, count_x)[0]
+    return np.argwhere(counts >= min_label_pixels).tolist()
+
+def tile_grid(height, width, data_padding, label_height, label_width):
+    "Number of tiles along y and x that breakdown_n_filter cuts an image into"
+    count_y = len(range(data_padding, height-label_height-data_padding+1, label_height))
+    count_x = len(range(data_padding, width-label_width-data_padding+1, label_width))
+    return (count_y, count_x)
+
+def _tile_view(data, count_y, count_x, step_y, step_x, tile_height, tile_width):
+    "Read-only strided view of data as a grid of possibly overlapping tiles"
+    data = np.asarray(data)
+    strides = data.strides
+    return as_strided(data,
+                      shape=(data.shape[0], count_y, count_x, tile_height, tile_width)
+                      + data.shape[3:],
+                      strides=(strides[0], step_y*strides[1], step_x*strides[2],
+                               strides[1], strides[2]) + strides[3:],
+                      writeable=False)
+
+def reduced_decode_mode(size, target_size):
+    """Largest IMREAD_REDUCED_COLOR_* mode that decodes an image of size
+    (width, height) to at least target_size, IMREAD_COLOR if none does"""
+    width, height = size
+    target_width, target_height = target_size
+    for factor, mode in REDUCED_COLOR_MODES:
+        if width // factor >= target_width and height // factor >= target_height:
+            return mode
+    return cv2.IMREAD_COLOR
+
+def decode_image(img_bytes, target_size=None):
+    """Decodes a color image, resized to target_size (width, height) if given
+
+    The size in the header picks a reduced decode mode, so large frames are
+    never decoded at full resolution only to be shrunk right after"""
+    mode = cv2.IMREAD_COLOR
+    if target_size is not None:
+        size = imagesize.image_size(io.BytesIO(img_bytes))
+        if size is not None:
+            mode = reduced_decode_mode(size, target_size)
+    img_data = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), mode)
+    if target_size is not None and img_data.shape[1::-1] != tuple(target_size):
+        img_data = cv2.resize(img_data, tuple(target_size), interpolation=cv2.INTER_AREA)
+    return img_data
+
+def decode_label(label_bytes, target_size=None):
+    """Decodes a label image, resized to target_size (width, height) if given
+
+    Nearest neighbour resizing keeps every pixel an exact class color"""
+    label_data = cv2.imdecode(np.frombuffer(label_bytes, np.uint8), cv2.IMREAD_UNCHANGED)
+    if target_size is not None and label_data.shape[1::-1] != tuple(target_size):
+        label_data = cv2.resize(label_data, tuple(target_size),
+                                interpolation=cv2.INTER_NEAREST)
+    return label_data
+
+def read_ahead(paths):
+    "Hints the OS to start reading the files at paths in the background"
+    if posix_fadvise is None:
+        return
+    for path in paths:
+        with open(path, "rb") as hinted_file:
+            posix_fadvise(hinted_file.fileno(), 0, 0, POSIX_FADV_WILLNEED)
+
+def load_file(task):
+    """Decode, tile, filter and encode one file of the data set
+
+    The label is decoded first, the image is not even read when no tile of
+    it is kept. Its tiles and hash are None then. Also returns the kept
+    tile positions for the label index"""
+    (data_path, file_name, data_padding, label_height, label_width, label_codec_name,
+     target_size, min_label_pixels) = task
+    # Modules do not pickle, workers import the label codec by name
+    label_codec = import_module(label_codec_name)
+
+    with open(join(data_path, LABEL_FOLDER, file_name), "rb") as label_file:
+        label_bytes = label_file.read()
+    t_label_data = decode_label(label_bytes, target_size)
+    tiles = kept_tiles(t_label_data, data_padding, label_height, label_width, min_label_pixels)
+    if not tiles:
+        return (t_label_data.shape[:2] + (3,), None, None, None, tiles)
+
+    # Read once, the same bytes are hashed for the cache manifest and decoded
+    with open(join(data_path, IMAGE_FOLDER, file_name), "rb") as img_file:
+        img_bytes = img_file.read()
+    t_img_data = decode_image(img_bytes, target_size)
+
+    img_data, label_data = breakdown_n_filter(np.array([t_img_data]), np.array([t_label_data]),
+                                              data_padding, label_height, label_width,
+                                              min_label_pixels=min_label_pixels)
+
+    p_label_data = label_codec.compact_label(label_data)
+
+    return (t_img_data.shape, img_data, p_label_data,
+            cachemanifest.content_digest(img_bytes, label_bytes), tiles)
+
+def load_tiles(settings, file_name):
+    """Decode, preprocess, tile, filter and encode one file, for the worker_processes
+
+    The batch preprocess hooks get the file as a batch of one frame. Files
+    in empty_files, and files none of whose tiles are kept, give no tiles
+    without their image being read"""
+    (data_path, data_padding, label_height, label_width, label_codec_name, target_size,
+     min_label_pixels, raw_preprocess, label_preprocess, raw_batch_preprocess,
+     label_batch_preprocess, tile_batch_preprocess, empty_files) = settings
+    label_codec = import_module(label_codec_name)
+    if file_name in empty_files:
+        return ([], [])
+
+    with open(join(data_path, LABEL_FOLDER, file_name), "rb") as label_file:
+        t_label_data = label_batch_preprocess(np.array(
+            [label_preprocess(decode_label(label_file.read(), target_size))]))
+    if not kept_tiles(t_label_data[0], data_padding, label_height, label_width,
+                      min_label_pixels):
+        return ([], [])
+    with open(join(data_path, IMAGE_FOLDER, file_name), "rb") as img_file:
+        t_img_data = raw_batch_preprocess(np.array(
+            [raw_preprocess(decode_image(img_file.read(), target_size))]))
+
+    img_data, label_data = breakdown_n_filter(t_img_data, t_label_data,
+                                              data_padding, label_height, label_width,
+                                              min_label_pixels=min_label_pixels)
+
+    return (tile_batch_preprocess(img_data), label_codec.compact_label(label_data))